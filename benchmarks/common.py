@@ -0,0 +1,6 @@
+"""Helpers shared by benchmark scripts. Scripts are run as files, so their folder is on sys.path"""
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
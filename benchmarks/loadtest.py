@@ -0,0 +1,227 @@
+"""Load test of the whole app: main.app on a seeded Postgres database with the in-memory storage backend.
+Replays a fixed mix of traffic and reports throughput and p50/p95/p99 latency per route to a JSON file.
+Requests are sent straight to the ASGI app in this process, so results do not depend on network and HTTP server.
+Needs a scratch database: schema sf in it is DROPPED and created again. Run from the repository root:
+    python benchmarks/loadtest.py --db postgresql://localhost/sf_bench --duration 30
+    python benchmarks/loadtest.py --db postgresql://localhost/sf_bench --compare benchmarks/results/<commit>.json
+Other settings (FAST_JSON, DB_POOL_MAX, ...) are taken from the environment as usual
+"""
+import os
+import sys
+import json
+import random
+import asyncio
+import argparse
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+from common import percentile  # noqa: E402
+
+MIX = {  # route -> share of requests
+    'login': 3,
+    'list_stories': 30,
+    'story_by_id': 12,
+    'story_content': 30,
+    'increase_param': 10,
+    'asset_content': 15,
+}
+PASSWORD = 'benchmark'
+ASSET = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 80  # ~20 KB
+
+
+def seed(db, users, stories, reviews, password_hash):
+    """Recreate schema sf from benchmarks/schema.sql and migrations, then fill it with generated rows"""
+    import psycopg
+    with psycopg.connect(db, autocommit=True) as conn:
+        conn.execute('DROP SCHEMA IF EXISTS sf CASCADE')
+        conn.execute((ROOT / 'benchmarks' / 'schema.sql').read_text())
+        for migration in sorted((ROOT / 'migrations').glob('*.sql')):
+            conn.execute(migration.read_text())
+        conn.execute("INSERT INTO sf.users (name, password) SELECT 'user' || i, %s FROM generate_series(1, %s) i",
+                     (password_hash, users))
+        conn.execute("""
+            INSERT INTO sf.stories (author, name, private, votes, created_at, updated_at)
+            SELECT 1 + i %% %s, 'Story ' || i, i %% 10 = 0, (random() * random() * 1000)::int,
+                   created, created + random() * (now() - created)
+            FROM (SELECT i, now() - random() * interval '365 days' AS created FROM generate_series(1, %s) i) t""",
+                     (users, stories))
+        conn.execute("""
+            INSERT INTO sf.reviews (author, story, content)
+            SELECT 1 + (s.id + j) %% %s, s.id, 'Review ' || j || ' of story ' || s.id
+            FROM sf.stories s, generate_series(1, %s) j""", (users, reviews))
+        conn.execute('ANALYZE')
+        return conn.execute('SELECT id, author, private FROM sf.stories ORDER BY id').fetchall()
+
+def story_xml(rng, story_id):
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'story', 'forge', 'dragon', 'castle', 'river']
+    paragraphs = ''.join(f'<p>{" ".join(rng.choices(words, k=80))}</p>' for _ in range(8))
+    return f'<story id="{story_id}"><title>Story {story_id}</title>{paragraphs}</story>'
+
+
+async def call(app, method, path, body=None):
+    """Send one request straight to the ASGI app. Returns status and response body"""
+    data = b'' if body is None else json.dumps(body).encode()
+    sent, received = False, []
+
+    async def receive():
+        nonlocal sent
+        if sent:
+            await asyncio.sleep(3600)  # only happens if the app waits for disconnect
+        sent = True
+        return {'type': 'http.request', 'body': data, 'more_body': False}
+
+    async def send(message):
+        received.append(message)
+
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+             'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+             'server': ('loadtest', 80), 'client': ('loadtest', 1),
+             'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(data)).encode())]}
+    await app(scope, receive, send)
+    return received[0]['status'], b''.join(m.get('body', b'') for m in received[1:])
+
+class Traffic:
+    """Builds requests of every route of MIX for one simulated client"""
+    def __init__(self, rng, stories, users, asset_stories):
+        self.rng = rng
+        self.public = [s[0] for s in stories if not s[2]]
+        self.users = users
+        self.by_author = {}
+        for story_id, author, _ in stories:
+            self.by_author.setdefault(author, []).append(story_id)
+        self.asset_stories = asset_stories
+        self.uid = self.sid = None  # set together, only when a login succeeds
+        self.login_uid = None
+
+    def login(self):
+        self.login_uid = self.rng.randint(1, self.users)
+        return 'POST', '/auth/login', {'login': f'user{self.login_uid}', 'password': PASSWORD}
+
+    def list_stories(self):
+        return 'PUT', '/storage/list_stories', {'listing_type': self.rng.choice(['home', 'best']), 'limit': 15,
+                                                'offset': self.rng.choice([0, 0, 0, 15, 30])}
+
+    def story_by_id(self):
+        return 'PUT', '/storage/story_by_id', {'id': self.rng.choice(self.public), 'detailed': True}
+
+    def story_content(self):
+        return 'PUT', '/storage/story_content', {'id': self.rng.choice(self.public)}
+
+    def increase_param(self):
+        # Votes are allowed only to authors (see routes.storage.increase_param)
+        return 'POST', '/storage/increase_param', {'sid': self.sid, 'id': self.rng.choice(self.by_author[self.uid]),
+                                                   'param': 'votes', 'type': 'stories', 'up_or_down': 1}
+
+    def asset_content(self):
+        return 'GET', f'/storage/asset_content/{self.rng.choice(self.asset_stories)}/cover.png', None
+
+async def client(app, traffic, results, start_at, end_at):
+    routes, weights = list(MIX), list(MIX.values())
+    while perf_counter() < end_at:
+        route = 'login' if traffic.sid is None or traffic.uid not in traffic.by_author else \
+            traffic.rng.choices(routes, weights)[0]
+        method, path, body = getattr(traffic, route)()
+        start = perf_counter()
+        status, response = await call(app, method, path, body)
+        elapsed = perf_counter() - start
+        if route == 'login' and status == 200:
+            traffic.uid, traffic.sid = traffic.login_uid, json.loads(response)['sid']
+        if start >= start_at:
+            results.setdefault(route, []).append((elapsed, status))
+
+def summarize(results, duration):
+    routes = {}
+    for route, samples in sorted(results.items()):
+        latencies = [elapsed * 1000 for elapsed, _ in samples]
+        routes[route] = {'requests': len(samples), 'errors': sum(status >= 400 for _, status in samples),
+                         'rps': round(len(samples) / duration, 1),
+                         **{f'p{p}_ms': round(percentile(latencies, p), 2) for p in (50, 95, 99)}}
+    all_latencies = [elapsed * 1000 for samples in results.values() for elapsed, _ in samples]
+    total = {'requests': len(all_latencies), 'errors': sum(r['errors'] for r in routes.values()),
+             'rps': round(len(all_latencies) / duration, 1),
+             **{f'p{p}_ms': round(percentile(all_latencies, p), 2) for p in (50, 95, 99)}}
+    return routes, total
+
+def print_report(report, baseline=None):
+    def change(route, key):
+        if baseline is None:
+            return ''
+        old = (baseline['total'] if route == 'total' else baseline['routes'].get(route, {})).get(key)
+        new = report['total'] if route == 'total' else report['routes'][route]
+        return f' ({(new[key] - old) / old * 100:+.0f}%)' if old else ''
+    print(f'{"route":<16}{"requests":>10}{"errors":>8}{"req/s":>18}{"p50 ms":>16}{"p95 ms":>16}{"p99 ms":>16}')
+    for route, r in [*report['routes'].items(), ('total', report['total'])]:
+        print(f'{route:<16}{r["requests"]:>10}{r["errors"]:>8}'
+              + ''.join(f'{str(r[k]) + change(route, k):>{w}}'
+                        for k, w in (('rps', 18), ('p50_ms', 16), ('p95_ms', 16), ('p99_ms', 16))))
+
+
+async def run(args):
+    import hashing
+    import box_api
+    import revisions
+    import main
+
+    rng = random.Random(args.seed)
+    print('Seeding database...')
+    stories = await asyncio.to_thread(seed, args.db, args.users, args.stories, args.reviews,
+                                      hashing._hash(PASSWORD))
+    for story_id, _, _ in stories:
+        box_api.backend.write(story_xml(rng, story_id).encode(), revisions.story_path(story_id, 0))
+    asset_stories = [s[0] for s in stories[:args.asset_stories]]
+    for story_id in asset_stories:
+        box_api.backend.write(ASSET, f'{os.environ['STORAGE_PREFIX']}/assets/{story_id}/cover.png')
+
+    results = {}
+    async with main.lifespan(main.app):
+        start_at = perf_counter() + args.warmup
+        end_at = start_at + args.duration
+        print(f'Running {args.concurrency} clients for {args.warmup}s warm-up + {args.duration}s...')
+        await asyncio.gather(*(client(main.app, Traffic(random.Random(args.seed + i), stories, args.users,
+                                                        asset_stories), results, start_at, end_at)
+                               for i in range(args.concurrency)))
+    routes, total = summarize(results, args.duration)
+    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    return {'commit': commit, 'date': datetime.now(timezone.utc).isoformat(),
+            'config': {k: v for k, v in vars(args).items() if k not in ('db', 'out', 'compare')}
+                      | {'mix': MIX, 'env': {k: v for k, v in os.environ.items()
+                                             if k.startswith(('DB_POOL', 'CACHE_', 'FAST_JSON', 'HASH_', 'VOTE_',
+                                                              'METRICS_', 'SESSION_'))}},
+            'routes': routes, 'total': total}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', required=True, help='scratch database, schema sf is dropped and recreated')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--stories', type=int, default=10000)
+    parser.add_argument('--reviews', type=int, default=3, help='reviews per story')
+    parser.add_argument('--asset-stories', type=int, default=500, help='stories that get an asset')
+    parser.add_argument('--concurrency', type=int, default=32, help='simultaneous clients')
+    parser.add_argument('--duration', type=float, default=30, help='seconds measured')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds before measuring')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', help='result file, benchmarks/results/<commit>.json by default')
+    parser.add_argument('--compare', help='earlier result file to compare with')
+    args = parser.parse_args()
+
+    os.environ['DB_PATH'] = args.db
+    os.environ['STORAGE_BACKEND'] = 'memory'
+    os.environ['STORAGE_PREFIX'] = '/bench'
+    os.environ['SESSION_STORE'] = 'memory'
+    os.environ['VOTE_JOURNAL_DIR'] = tempfile.mkdtemp(prefix='sf-votes-')
+
+    report = asyncio.run(run(args))
+    out = Path(args.out or ROOT / 'benchmarks' / 'results' / f'{report["commit"][:12] or "unknown"}.json')
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, indent=2))
+    print_report(report, json.loads(Path(args.compare).read_text()) if args.compare else None)
+    print(f'Saved to {out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Measures latency of an unrelated endpoint while many clients log in at once.
+Start the server first, register the user, then run:
+    python benchmarks/login_storm.py --url http://localhost:8000 --login bench --password bench
+"""
+import argparse
+import json
+import threading
+from time import perf_counter, sleep
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+from common import percentile
+
+
+def login_worker(url, body, stop, statuses):
+    while not stop.is_set():
+        try:
+            with urlopen(Request(f'{url}/auth/login', body, {'Content-Type': 'application/json'})) as resp:
+                statuses.append(resp.status)
+        except HTTPError as e:
+            statuses.append(e.code)
+
+def probe(url, duration):
+    """Latencies (ms) of /ping requests made one after another for `duration` seconds"""
+    latencies = []
+    end = perf_counter() + duration
+    while perf_counter() < end:
+        start = perf_counter()
+        urlopen(f'{url}/ping').read()
+        latencies.append((perf_counter() - start) * 1000)
+        sleep(0.01)
+    return latencies
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--login', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--clients', type=int, default=32, help='concurrent login loops')
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args()
+
+    idle = probe(args.url, args.duration / 2)
+    stop, statuses = threading.Event(), []
+    body = json.dumps({'login': args.login, 'password': args.password}).encode()
+    threads = [threading.Thread(target=login_worker, args=(args.url, body, stop, statuses))
+               for _ in range(args.clients)]
+    for t in threads:
+        t.start()
+    storm = probe(args.url, args.duration)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    for name, latencies in (('idle', idle), ('login storm', storm)):
+        print(f'/ping {name}: p50={percentile(latencies, 50):.1f}ms p99={percentile(latencies, 99):.1f}ms '
+              f'n={len(latencies)}')
+    print('login responses:', {code: statuses.count(code) for code in sorted(set(statuses))})
+
+
+if __name__ == '__main__':
+    main()
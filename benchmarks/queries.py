@@ -0,0 +1,58 @@
+"""Compares latency of hot queries sent as one-off text (like the old f-string SQL) and as prepared statements.
+Needs a database with some stories and reviews. Run from the repository root:
+    DB_PATH=postgresql://... python benchmarks/queries.py --iterations 2000
+"""
+import os
+import sys
+import asyncio
+import argparse
+from time import perf_counter
+from psycopg import AsyncConnection, AsyncClientCursor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import queries as q  # noqa: E402
+from common import percentile  # noqa: E402
+
+
+async def run(conn, sql, params, iterations, prepare):
+    """Latencies (ms) of executing sql `iterations` times on one connection"""
+    latencies = []
+    # Literal values bound on the client make every statement unique, so the server plans each of them again
+    text = AsyncClientCursor(conn).mogrify(sql, params)
+    for _ in range(iterations):
+        start = perf_counter()
+        async with conn.cursor() as cur:
+            if prepare:
+                await cur.execute(sql, params, prepare=True)
+            else:
+                await cur.execute(text, prepare=False)
+            await cur.fetchall()
+        latencies.append((perf_counter() - start) * 1000)
+    return latencies
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=1000)
+    args = parser.parse_args()
+
+    async with await AsyncConnection.connect(os.environ['DB_PATH']) as conn:
+        cur = await conn.execute('SELECT min(id) FROM sf.stories')
+        story = (await cur.fetchone())[0]
+        cur = await conn.execute('SELECT author FROM sf.stories WHERE id=%s', (story,))
+        author = (await cur.fetchone())[0]
+        cases = {
+            'story_by_id': (q.STORY_BY_ID_DETAILED, (story,)),
+            'story_owner': (q.STORY_OWNER, (story,)),
+            'user_name': (q.USER_NAME, (author,)),
+            'list_stories home': (q.LIST_STORIES['home', False], (15, 0)),
+            'list_stories user': (q.LIST_STORIES['user', False], (author, 15, 0)),
+        }
+        for name, (sql, params) in cases.items():
+            for prepare in (False, True):
+                latencies = await run(conn, sql, params, args.iterations, prepare)
+                print(f'{name} {"prepared" if prepare else "text"}: p50={percentile(latencies, 50):.3f}ms '
+                      f'p99={percentile(latencies, 99):.3f}ms')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
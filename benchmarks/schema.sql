@@ -0,0 +1,29 @@
+-- Base tables of the sf schema as used by the app, for benchmark databases.
+-- Production databases already have them; apply migrations/*.sql after this file
+CREATE SCHEMA IF NOT EXISTS sf;
+
+CREATE TABLE IF NOT EXISTS sf.users (
+    id serial PRIMARY KEY,
+    name text NOT NULL UNIQUE,
+    password text NOT NULL,
+    contact text
+);
+
+CREATE TABLE IF NOT EXISTS sf.stories (
+    id serial PRIMARY KEY,
+    author integer NOT NULL REFERENCES sf.users (id),
+    name text NOT NULL,
+    votes integer NOT NULL DEFAULT 0,
+    private boolean NOT NULL DEFAULT false,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS sf.reviews (
+    id serial PRIMARY KEY,
+    author integer NOT NULL REFERENCES sf.users (id),
+    story integer NOT NULL REFERENCES sf.stories (id) ON DELETE CASCADE,
+    content text NOT NULL,
+    votes integer NOT NULL DEFAULT 0,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
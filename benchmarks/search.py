@@ -0,0 +1,81 @@
+"""Latency of /storage/search_stories queries on a synthetic corpus.
+Inserts the corpus into the database from DB_PATH inside a transaction and rolls it back at the end, so nothing
+is left behind. Needs migrations up to 007_story_search.sql. Run from the repository root:
+    DB_PATH=postgresql://... python benchmarks/search.py --stories 100000
+"""
+import os
+import sys
+import random
+import asyncio
+import argparse
+from time import perf_counter
+from psycopg import AsyncConnection
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import queries as q  # noqa: E402
+from common import percentile  # noqa: E402
+
+VOCABULARY_SIZE = 20000
+
+
+def make_vocabulary(rng):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return list(dict.fromkeys(''.join(rng.choice(letters) for _ in range(rng.randint(3, 10)))
+                              for _ in range(VOCABULARY_SIZE)))
+
+async def fill(conn, stories, words_per_story, vocabulary):
+    """Stories by one user, every 10th is private. Words are picked with a skewed distribution like in real text"""
+    cur = await conn.execute("INSERT INTO sf.users (name, password) VALUES ('search-benchmark', '') RETURNING id")
+    uid = (await cur.fetchone())[0]
+    await conn.execute("""
+        INSERT INTO sf.stories (name, author, private)
+        SELECT 'Story ' || i || ' ' || (%s::text[])[1 + floor(power(random(), 3) * array_length(%s::text[], 1))::int],
+               %s, i %% 10 = 0
+        FROM generate_series(1, %s) i""", (vocabulary, vocabulary, uid, stories))
+    await conn.execute("""
+        UPDATE sf.story_search f SET content = to_tsvector('simple', (
+            SELECT string_agg((%s::text[])[1 + floor(power(random(), 3) * array_length(%s::text[], 1))::int], ' ')
+            FROM generate_series(1, %s) g WHERE g > -f.story))
+        FROM sf.stories s WHERE s.id = f.story AND s.author = %s""",
+                       (vocabulary, vocabulary, words_per_story, uid))
+    await conn.execute('ANALYZE sf.story_search')
+    return uid
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stories', type=int, default=100000)
+    parser.add_argument('--words', type=int, default=300, help='words of content per story')
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+    rng = random.Random(1)
+    vocabulary = make_vocabulary(rng)
+
+    async with await AsyncConnection.connect(os.environ['DB_PATH']) as conn:
+        start = perf_counter()
+        uid = await fill(conn, args.stories, args.words, vocabulary)
+        print(f'Inserted and indexed {args.stories} stories in {perf_counter() - start:.1f}s')
+        cases = {
+            'common word': vocabulary[0],
+            'rare word': vocabulary[-1],
+            'two words': f'{vocabulary[5]} {vocabulary[500]}',
+            'phrase': f'"{vocabulary[1]} {vocabulary[2]}"',
+            'or': f'{vocabulary[3000]} or {vocabulary[4000]}',
+            'no matches': 'zzzzzzzzzzzz',
+        }
+        try:
+            for name, query in cases.items():
+                for viewer in (None, uid):
+                    latencies = []
+                    for _ in range(args.iterations):
+                        t = perf_counter()
+                        cur = await conn.execute(q.SEARCH_STORIES, (query, viewer, 15, 0), prepare=True)
+                        await cur.fetchall()
+                        latencies.append((perf_counter() - t) * 1000)
+                    print(f'{name} ({"author" if viewer else "anonymous"}): p50={percentile(latencies, 50):.2f}ms '
+                          f'p99={percentile(latencies, 99):.2f}ms')
+        finally:
+            await conn.rollback()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+"""Requests per second of one core for /storage/list_stories with pydantic and with FAST_JSON serialization.
+The database is replaced by rows kept in memory, so only request handling and serialization are measured.
+Run from the repository root (orjson must be installed):
+    python benchmarks/serialization.py --limit 100 --duration 5
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DB_PATH', 'postgresql://localhost/unused')
+os.environ.setdefault('STORAGE_PREFIX', '/bench')
+os.environ.setdefault('STORAGE_BACKEND', 'local')
+import fast_json  # noqa: E402
+import routes.storage as storage  # noqa: E402
+from main import app  # noqa: E402
+
+
+def make_rows(count):
+    now = datetime.now(timezone.utc)
+    return [{'id': i, 'author': i % 50, 'name': f'Story number {i}', 'votes': i * 3, 'rank': 1000.0 - i,
+             'reviews': list(range(i, i + 5)), 'private': False,
+             'created_at': now - timedelta(hours=i), 'updated_at': now - timedelta(minutes=i)}
+            for i in range(count, 0, -1)]
+
+async def request(body):
+    """Send one PUT /storage/list_stories straight to the ASGI app. Returns status and response body"""
+    sent, received = False, []
+
+    async def receive():
+        nonlocal sent
+        if sent:
+            return {'type': 'http.disconnect'}
+        sent = True
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        received.append(message)
+
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'PUT',
+             'scheme': 'http', 'path': '/storage/list_stories', 'raw_path': b'/storage/list_stories',
+             'query_string': b'', 'root_path': '', 'server': ('bench', 80), 'client': ('bench', 1),
+             'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]}
+    await app(scope, receive, send)
+    return received[0]['status'], b''.join(m.get('body', b'') for m in received[1:])
+
+async def measure(body, duration):
+    count, end = 0, perf_counter() + duration
+    while perf_counter() < end:
+        status, _ = await request(body)
+        assert status == 200, status
+        count += 1
+    return count / duration
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--limit', type=int, default=15, help='stories per page')
+    parser.add_argument('--duration', type=float, default=5)
+    args = parser.parse_args()
+    if fast_json.orjson is None:
+        sys.exit('orjson is not installed')
+
+    rows = make_rows(args.limit)
+
+    @asynccontextmanager
+    async def fake_conn():
+        yield None
+
+    async def fake_fetch_all(conn, sql, params=(), row_type=None):
+        return rows
+
+    storage.get_conn, storage.fetch_all = fake_conn, fake_fetch_all
+    body = json.dumps({'limit': args.limit}).encode()
+
+    results = {}
+    for enabled in (False, True):
+        fast_json.enabled = enabled
+        await measure(body, 0.5)  # warm up
+        results[enabled] = await measure(body, args.duration)
+    fast_json.enabled = False
+    slow = json.loads((await request(body))[1])
+    fast_json.enabled = True
+    fast = json.loads((await request(body))[1])
+    assert slow == fast, 'responses differ'
+
+    print(f'list_stories limit={args.limit}: pydantic {results[False]:.0f} req/s, '
+          f'FAST_JSON {results[True]:.0f} req/s ({results[True] / results[False]:.2f}x)')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,24 +1,88 @@
-"""Interface module for Dropbox api. Provides functions required are only for project purposes"""
+"""Interface module for file storage (Dropbox by default). Provides functions required are only for project purposes.
+File operations are coroutines: blocking backend calls run in a bounded thread pool, so a slow download
+does not stall the event loop. Set STORAGE_BACKEND=local to keep files in LOCAL_STORAGE_ROOT folder instead of Dropbox
+(or STORAGE_BACKEND=memory to keep them in this process, for benchmarks)"""
 import os
+import base64
+import asyncio
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from typing import BinaryIO
 import dropbox
 from dropbox import DropboxOAuth2FlowNoRedirect
 from dotenv import load_dotenv
+from storage_backends import StorageBackend, DropboxBackend, LocalBackend, MemoryBackend, FileMeta, CHUNK_SIZE, BATCH_SIZE
+from cache import ByteCache
+import metrics
 load_dotenv()
 
 DBX_APP_KEY = os.getenv('DBX_APP_KEY')
+DBX_CONCURRENCY = int(os.getenv('DBX_CONCURRENCY', '8'))  # max simultaneous Dropbox calls per process
+DBX_TIMEOUT = float(os.getenv('DBX_TIMEOUT', '30'))  # seconds
+ASSET_BATCH_CONCURRENCY = int(os.getenv('ASSET_BATCH_CONCURRENCY', '4'))  # files of one bulk upload sent at once
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'dropbox')
 dbx: dropbox.Dropbox = None
+if STORAGE_BACKEND == 'local':
+    backend: StorageBackend = LocalBackend(os.getenv('LOCAL_STORAGE_ROOT', 'local_storage'))
+elif STORAGE_BACKEND == 'memory':
+    backend = MemoryBackend()
+else:
+    backend = DropboxBackend()
 auth_url: str | None = None
 auth_flow = None
 
-authorized = lambda: bool(dbx)
+_executor = ThreadPoolExecutor(DBX_CONCURRENCY, thread_name_prefix='storage')
+cache = ByteCache(max_bytes=int(os.getenv('CACHE_MAX_BYTES', str(64 * 2**20))),
+                  max_item_bytes=int(os.getenv('CACHE_MAX_ITEM_BYTES', str(4 * 2**20))),
+                  ttl=float(os.getenv('CACHE_TTL', '300')),
+                  disk_dir=os.getenv('CACHE_DIR') or None,
+                  disk_max_bytes=int(os.getenv('CACHE_DISK_MAX_BYTES', str(2**30))))
+_meta: OrderedDict[str, tuple[FileMeta, float]] = OrderedDict()  # metadata of recently requested files
+META_CACHE_SIZE = 10000
+_listings: OrderedDict[str, tuple[list[str], float]] = OrderedDict()  # folder -> names of its entries
+LISTING_CACHE_SIZE = 10000
+_listing_generation = 0  # changes on every write, so a listing fetched during a write is not cached
+
+authorized = lambda: backend.ready()
+
+async def _run(func, *args, timeout=DBX_TIMEOUT):
+    """Run blocking call in the storage thread pool. Raises TimeoutError after `timeout` seconds"""
+    loop = asyncio.get_running_loop()
+    with metrics.span(metrics.storage_calls, getattr(func, '__name__', 'call').lstrip('_')):
+        return await asyncio.wait_for(loop.run_in_executor(_executor, func, *args), timeout)
+
+def _auth_flow():
+    """PKCE flow whose code verifier is kept in dbx_pkce file, so the auth code from a link shown by one worker
+    can be finished by any other worker"""
+    flow = DropboxOAuth2FlowNoRedirect(DBX_APP_KEY, use_pkce=True, token_access_type='offline')
+    try:
+        with open('dbx_pkce') as f:
+            flow.code_verifier = f.readline().strip()
+        flow.code_challenge = base64.urlsafe_b64encode(
+            hashlib.sha256(flow.code_verifier.encode()).digest()).decode().rstrip('=')
+    except OSError:
+        with open('dbx_pkce', 'w') as f:
+            f.write(flow.code_verifier)
+    return flow
 
 def get_link():
     """Get link to get auth code"""
     global auth_url, auth_flow
-    auth_flow = DropboxOAuth2FlowNoRedirect(DBX_APP_KEY, use_pkce=True, token_access_type='offline')
+    auth_flow = _auth_flow()
     auth_url = auth_flow.start()
     return auth_url
 
+def saved_token() -> str | None:
+    """Refresh token of an earlier login (dbx_token file or DBX_TOKEN), None if Dropbox must be authorized on /dbx page"""
+    try:
+        with open('dbx_token') as f:
+            token = f.readline().strip()
+    except OSError:
+        token = ''
+    return token or os.getenv('DBX_TOKEN') or None
+
 def login(auth_code):
     """Login with auth code to get Dropbox 'refresh token'"""
     global dbx
@@ -32,13 +96,17 @@ def login(auth_code):
         print(e)
         token = os.getenv('DBX_TOKEN')
         if not token:
-            oauth_result = auth_flow.finish(auth_code)
+            oauth_result = (auth_flow or _auth_flow()).finish(auth_code)
             token = oauth_result.refresh_token
+            if os.path.exists('dbx_pkce'):
+                os.remove('dbx_pkce')
         with open('dbx_token', 'w') as f:
             f.write(token)
     try:
-        dbx = dropbox.Dropbox(oauth2_refresh_token=token, app_key=DBX_APP_KEY)
+        dbx = dropbox.Dropbox(oauth2_refresh_token=token, app_key=DBX_APP_KEY, timeout=DBX_TIMEOUT)
         dbx.users_get_current_account()
+        if isinstance(backend, DropboxBackend):
+            backend.dbx = dbx
         print('Successfully logged into Dropbox')
     except dropbox.exceptions.AuthError as e:
         print(e)
@@ -46,30 +114,169 @@ def login(auth_code):
             f.write(' ')
             print('dbx_token is literally dead')
 
-def list_files(path: str):
-    """List all files in specified Dropbox folder. Returns just a list of entries"""
-    return dbx.files_list_folder(path).entries
+async def list_files(path: str):
+    """List all files in specified folder. Returns just a list of names.
+    Listings are cached until something is written to the folder by this worker, or for cache.ttl seconds"""
+    folder = path.rstrip('/')
+    names, stored_at = _listings.get(folder, (None, 0))
+    if names is None or cache.ttl and time() - stored_at > cache.ttl:
+        generation = _listing_generation
+        names = await _run(backend.list, path)
+        if generation == _listing_generation:
+            _listings[folder] = names, time()
+            _listings.move_to_end(folder)
+            if len(_listings) > LISTING_CACHE_SIZE:
+                _listings.popitem(last=False)
+    return list(names)
 
-def file_content(file, decode=True):
-    """Read file. By default, decode parameter is true, which means the function will return plain text. Otherwise, will return raw bytes"""
-    resp = dbx.files_download(file)[1].content
+def _read_through(path):
+    token = cache.token()
+    data = cache.get_disk(path)
+    if data is None:
+        data = backend.read(path)
+        cache.put(path, data, token)
+    return data
+
+async def file_content(file, decode=True):
+    """Read file. By default, decode parameter is true, which means the function will return plain text. Otherwise, will return raw bytes.
+    Recently read files are served from cache"""
+    resp = cache.get(file)
+    if resp is None:
+        resp = await _run(_read_through, file)
     return resp.decode() if decode else resp
 
-def upload(data, path):
-    """Upload raw bytes to Dropbox folder"""
-    return dbx.files_upload(data, path, dropbox.files.WriteMode.overwrite)
+def _open(path):
+    data = cache.get_disk(path)
+    if data is not None:
+        return len(data), iter((data,))
+    return backend.open(path)
+
+async def _single_chunk(data):
+    yield data
+
+async def _chunks(path, size, chunks, token):
+    buffer = [] if size <= cache.max_item_bytes else None  # small files are cached once fully sent
+    try:
+        while (chunk := await _run(next, chunks, None)) is not None:
+            if buffer is not None:
+                buffer.append(chunk)
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):  # generators of backends, not iterators over data already in memory
+            chunks.close()
+    if buffer is not None:
+        await _run(cache.put, path, b''.join(buffer), token)
+
+async def open_stream(path):
+    """Open file for streaming. Returns size of the file and async iterator over chunks of raw bytes.
+    Raises FileNotFoundError right away, so caller can handle it before sending the response"""
+    data = cache.get(path)
+    if data is not None:
+        return len(data), _single_chunk(data)
+    token = cache.token()
+    size, chunks = await _run(_open, path)
+    return size, _chunks(path, size, chunks, token)
+
+async def byte_range(chunks, start, stop):
+    """Bytes start..stop-1 of a stream from open_stream. Stops reading the file once they are sent.
+    Preceding bytes are still read, since backends download files from the beginning"""
+    position = 0
+    try:
+        async for chunk in chunks:
+            if position + len(chunk) > start:
+                yield chunk[max(start - position, 0):stop - position]
+            position += len(chunk)
+            if position >= stop:
+                break
+    finally:
+        await chunks.aclose()
+
+async def file_meta(path) -> FileMeta:
+    """ETag and modification time of the file, used for HTTP caching"""
+    meta, stored_at = _meta.get(path, (None, 0))
+    if meta is None or cache.ttl and time() - stored_at > cache.ttl:
+        meta = await _run(backend.stat, path)
+        _meta[path] = meta, time()
+        if len(_meta) > META_CACHE_SIZE:
+            _meta.popitem(last=False)
+    return meta
+
+def _invalidate(path, folder=False):
+    global _listing_generation
+    _listing_generation += 1
+    cache.invalidate(path)
+    _meta.pop(path, None)
+    _listings.pop(path.rstrip('/').rpartition('/')[0], None)
+    if folder:
+        _listings.pop(path.rstrip('/'), None)
+        prefix = path.rstrip('/') + '/'
+        cache.invalidate_prefix(prefix)
+        for k in [k for k in _meta if k.startswith(prefix)]:
+            del _meta[k]
+        for k in [k for k in _listings if k.startswith(prefix)]:
+            del _listings[k]
+
+async def upload(data, path):
+    """Upload raw bytes to storage folder. Overwrites existing file"""
+    try:
+        return await _run(backend.write, data, path)
+    finally:
+        _invalidate(path)
+
+async def upload_file(file, path, size):
+    """Upload file object of known size chunk by chunk. Overwrites existing file"""
+    try:
+        return await _run(backend.write_stream, file, path, timeout=DBX_TIMEOUT * (1 + size // CHUNK_SIZE))
+    finally:
+        _invalidate(path)
+
+async def upload_many(files: list[tuple[BinaryIO, str, int]]) -> list[str | None]:
+    """Upload several (file object, path, size). Contents are sent ASSET_BATCH_CONCURRENCY at a time
+    and then committed together with one batch call where backend supports it. Returns error or None for every file"""
+    semaphore = asyncio.Semaphore(ASSET_BATCH_CONCURRENCY)
 
-def delete(path):  # also applicable to folders
+    async def stage(file, size):
+        async with semaphore:
+            return await _run(backend.stage, file, timeout=DBX_TIMEOUT * (1 + size // CHUNK_SIZE))
+    try:
+        staged = await asyncio.gather(*(stage(file, size) for file, _, size in files), return_exceptions=True)
+        ready = [(s, path) for s, (_, path, _) in zip(staged, files) if not isinstance(s, BaseException)]
+        committed = iter(await _run(backend.commit_many, ready, timeout=DBX_TIMEOUT * (1 + len(ready) // BATCH_SIZE))
+                         if ready else ())
+        return [(str(s) or type(s).__name__) if isinstance(s, BaseException) else next(committed) for s in staged]
+    finally:
+        for _, path, _ in files:
+            _invalidate(path)
+
+async def delete_many(paths: list[str]) -> list[str | None]:
+    """Remove several files/folders with one batch call where backend supports it. Returns error or None for every path"""
+    try:
+        return await _run(backend.delete_many, paths, timeout=DBX_TIMEOUT * (1 + len(paths) // BATCH_SIZE))
+    finally:
+        for path in paths:
+            _invalidate(path, folder=True)
+
+async def delete(path):  # also applicable to folders
     """Remove specified file/folder. Folder might be not empty, be careful!"""
-    return dbx.files_delete(path)
+    try:
+        return await _run(backend.delete, path)
+    finally:
+        _invalidate(path, folder=True)
 
-def mkdir(path):
+async def mkdir(path):
     """Create folder"""
-    return dbx.files_create_folder(path)
+    return await _run(backend.mkdir, path)
 
-def copy_files(frm, to):
+async def copy_files(frm, to):
     """Copy file from one folder to other folder"""
-    dbx.files_copy_v2(from_path=frm, to_path=to)
+    try:
+        await _run(backend.copy, frm, to)
+    finally:
+        _invalidate(to, folder=True)
+
+def local_path(path):
+    """Path of the file on local disk if it can be sent directly, otherwise None"""
+    return backend.local_path(path)
 
 if __name__ == '__main__':
     login(input().strip())
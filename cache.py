@@ -0,0 +1,174 @@
+"""Size-bounded LRU cache for file contents with an optional on-disk second tier"""
+import os
+import hashlib
+from collections import OrderedDict
+from contextlib import suppress
+from pathlib import Path
+from threading import Lock
+from time import time
+from urllib.parse import quote, unquote
+from loguru import logger
+
+
+class ByteCache:
+    """Keeps at most `max_bytes` of data in memory, evicting least recently used entries.
+    Entries bigger than `max_item_bytes` are not cached. With `ttl` entries expire after that many seconds.
+    With `disk_dir` entries are also written to disk (up to `disk_max_bytes`) and survive restarts.
+    Thread-safe: box_api fills it from its thread pool"""
+    def __init__(self, max_bytes: int, max_item_bytes: int, ttl: float = 0,
+                 disk_dir: str | None = None, disk_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.ttl = ttl
+        self._items: OrderedDict[str, tuple[bytes, float]] = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+        self._invalidations = 0
+        self.hits = self.misses = self.evictions = self.disk_hits = 0
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.disk_max_bytes = disk_max_bytes
+        self._disk: OrderedDict[str, int] = OrderedDict()  # key -> size, oldest first
+        self._disk_size = 0
+        if self.disk_dir:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            for f in sorted(self.disk_dir.iterdir(), key=lambda f: f.stat().st_mtime):
+                key = self._disk_key(f)
+                if key is None:  # temporary file of a crashed write or an entry of the older format
+                    f.unlink(missing_ok=True)
+                    continue
+                self._disk[key] = f.stat().st_size
+                self._disk_size += f.stat().st_size
+
+    def _expired(self, stored_at):
+        return self.ttl and time() - stored_at > self.ttl
+
+    def get(self, key: str) -> bytes | None:
+        """Memory lookup. Cheap enough to call from the event loop"""
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or self._expired(item[1]):
+                if item is not None:
+                    self._pop(key)
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def get_disk(self, key: str) -> bytes | None:
+        """Disk tier lookup. Does file I/O, so call it from a worker thread"""
+        if not self.disk_dir:
+            return None
+        with self._lock:
+            if key not in self._disk:
+                return None
+        file = self._disk_file(key)
+        try:
+            if self._expired(file.stat().st_mtime):
+                self._drop_disk(key)
+                return None
+            header, _, data = file.read_bytes().partition(b'\n')
+        except OSError:
+            return None
+        if unquote(header.decode()) != key:
+            return None
+        with self._lock:
+            self.disk_hits += 1
+            self._put_memory(key, data)
+        return data
+
+    def token(self) -> int:
+        """Take it before reading the source and pass to put(), so data read before invalidation is not cached"""
+        return self._invalidations
+
+    def put(self, key: str, data: bytes, token: int | None = None):
+        if len(data) > self.max_item_bytes:
+            return
+        with self._lock:
+            if token is not None and token != self._invalidations:
+                return
+            self._put_memory(key, data)
+        if self.disk_dir:
+            self._put_disk(key, data, token)
+
+    def invalidate(self, key: str):
+        self.invalidate_prefix(key, exact=True)
+
+    def invalidate_prefix(self, prefix: str, exact=False):
+        """Remove entry (or all entries starting with prefix, e.g. a folder) from both tiers"""
+        with self._lock:
+            self._invalidations += 1
+            keys = [prefix] if exact else [k for k in self._items if k.startswith(prefix)]
+            for k in keys:
+                self._pop(k)
+            disk_keys = [k for k in self._disk if k == prefix or not exact and k.startswith(prefix)]
+        for k in disk_keys:
+            self._drop_disk(k)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'disk_hits': self.disk_hits, 'entries': len(self._items), 'bytes': self._size,
+                    'max_bytes': self.max_bytes, 'disk_bytes': self._disk_size}
+
+    def _put_memory(self, key, data):
+        self._pop(key)
+        self._items[key] = (data, time())
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            _, (old, _) = self._items.popitem(last=False)
+            self._size -= len(old)
+            self.evictions += 1
+
+    def _pop(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._size -= len(item[0])
+
+    def _disk_file(self, key):
+        # Fixed-length name: keys of any length or alphabet fit file system limits
+        return self.disk_dir / hashlib.sha256(key.encode()).hexdigest()
+
+    def _disk_key(self, file):
+        """Key stored in the first line of a disk entry, None if the file is not an entry"""
+        if len(file.name) != 64 or file.suffix:
+            return None
+        try:
+            with open(file, 'rb') as f:
+                key = unquote(f.readline().rstrip(b'\n').decode())
+        except (OSError, UnicodeDecodeError):
+            return None
+        return key if self._disk_file(key) == file else None
+
+    def _put_disk(self, key, data, token):
+        """Best effort: a failed write only means the entry is not on disk"""
+        file = self._disk_file(key)
+        tmp = file.with_name(f'{file.name}.{os.getpid()}.tmp')
+        entry = quote(key).encode() + b'\n' + data
+        try:
+            tmp.write_bytes(entry)
+            os.replace(tmp, file)
+        except OSError as e:
+            logger.warning(f'Could not write {key} to disk cache: {e}')
+            with suppress(OSError):
+                tmp.unlink(missing_ok=True)
+            return
+        stale = []
+        with self._lock:
+            if token is not None and token != self._invalidations:
+                stale.append(key)  # invalidated while we were writing
+                self._disk_size -= self._disk.pop(key, 0)
+            else:
+                self._disk_size += len(entry) - self._disk.pop(key, 0)
+                self._disk[key] = len(entry)
+                while self._disk_size > self.disk_max_bytes and self._disk:
+                    old, size = self._disk.popitem(last=False)
+                    self._disk_size -= size
+                    stale.append(old)
+        for old in stale:
+            self._disk_file(old).unlink(missing_ok=True)
+
+    def _drop_disk(self, key):
+        with self._lock:
+            self._disk_size -= self._disk.pop(key, 0)
+        self._disk_file(key).unlink(missing_ok=True)
@@ -0,0 +1,117 @@
+"""Response compression negotiated by Accept-Encoding: zstd, brotli and gzip. brotli and zstandard packages are in
+requirements.txt, but are optional: without them only gzip is used. Only JSON, XML and text bodies are compressed.
+Responses that already have Content-Encoding (e.g. pre-compressed story content) are sent as they are"""
+import os
+import gzip
+from fastapi.responses import Response
+from loguru import logger
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', '1024'))  # smaller bodies are sent as they are
+_compressors = {
+    'zstd': zstd and (lambda data: zstd.compress(data, level=3)),
+    'br': brotli and (lambda data: brotli.compress(data, quality=5)),
+    'gzip': lambda data: gzip.compress(data, compresslevel=6, mtime=0),
+}
+# In order of preference when the client accepts several equally
+ENCODINGS = [e.strip() for e in os.environ.get('COMPRESSION_ENCODINGS', ','.join(_compressors)).split(',')
+             if e.strip()]
+for e in ENCODINGS:
+    if _compressors.get(e) is None and 'COMPRESSION_ENCODINGS' in os.environ:
+        logger.warning(f'Compression "{e}" is not supported or its package is not installed')
+ENCODINGS = [e for e in ENCODINGS if _compressors.get(e) is not None]
+
+
+def negotiate(accept_encoding: str | None) -> str | None:
+    """Best supported encoding the client accepts, None for identity"""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        q = 1.0
+        if params.strip().startswith('q='):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                continue
+        accepted[name.strip().lower()] = q
+    candidates = [(accepted.get(e, accepted.get('*', 0)), -i, e) for i, e in enumerate(ENCODINGS)]
+    q, _, best = max(candidates, default=(0, 0, None))
+    return best if q > 0 else None
+
+def compress(data: bytes, encoding: str) -> bytes:
+    return _compressors[encoding](data)
+
+def _weak(etag: str) -> str:
+    # Compressed body differs from the plain one byte for byte, so it is only weakly equal to it
+    return etag if etag.startswith('W/') else f'W/{etag}'
+
+def response(body: bytes, encoding: str, media_type: str, headers: dict | None = None) -> Response:
+    """Response with an already compressed body"""
+    headers = dict(headers or {})
+    if 'ETag' in headers:
+        headers['ETag'] = _weak(headers['ETag'])
+    headers |= {'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'}
+    return Response(body, media_type=media_type, headers=headers)
+
+
+def _compressible(content_type: str) -> bool:
+    content_type = content_type.split(';')[0].strip()
+    return content_type.startswith('text/') or content_type in ('application/json', 'application/xml') \
+        or content_type.endswith(('+json', '+xml'))
+
+class CompressionMiddleware:
+    """Compresses whole (not streamed) JSON, XML and text responses of at least COMPRESSION_MIN_BYTES"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        encoding = negotiate(Headers(scope=scope).get('accept-encoding'))
+        start = None
+
+        async def send_compressed(message):
+            nonlocal start
+            if message['type'] == 'http.response.start':
+                start = message  # held until the body shows whether to compress
+                return
+            if start is None:
+                return await send(message)
+            if message['type'] != 'http.response.body':  # e.g. http.response.pathsend of FileResponse
+                await send(start)
+                start = None
+                return await send(message)
+            headers = MutableHeaders(raw=start['headers'])
+            body = message.get('body', b'')
+            if not _compressible(headers.get('content-type', '')) or 'content-encoding' in headers:
+                pass
+            elif encoding is None or message.get('more_body') or len(body) < COMPRESSION_MIN_BYTES \
+                    or start['status'] in (204, 206, 304):
+                headers.add_vary_header('Accept-Encoding')
+            else:
+                body = compress(body, encoding)
+                headers['Content-Encoding'] = encoding
+                headers['Content-Length'] = str(len(body))
+                headers.add_vary_header('Accept-Encoding')
+                if 'etag' in headers:
+                    headers['ETag'] = _weak(headers['etag'])
+                message = {**message, 'body': body}
+            await send(start)
+            start = None
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
@@ -0,0 +1,30 @@
+"""Opt-in fast path for list endpoints. Rows are copied into plain dicts with the field layout of the response
+model and encoded by orjson, skipping creation, validation and serialization of a pydantic model per row.
+Routes keep their response models, so OpenAPI schema does not change. Enable with FAST_JSON=1 (needs orjson)"""
+import os
+from fastapi.responses import Response
+from loguru import logger
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FAST_JSON = os.environ.get('FAST_JSON', '0') == '1'
+if FAST_JSON and orjson is None:
+    logger.warning('FAST_JSON=1 but orjson is not installed, responses are serialized by pydantic')
+enabled = FAST_JSON and orjson is not None
+
+
+def layout(model: type[BaseModel]) -> tuple[tuple[str, object], ...]:
+    """Fields of the model in output order with values used when a row has no such column"""
+    return tuple((name, field.default) for name, field in model.model_fields.items())
+
+def project(rows: list[dict], fields: tuple[tuple[str, object], ...]) -> list[dict]:
+    """Rows as dicts with exactly the fields of the model. Extra columns (e.g. rank) are dropped"""
+    return [{name: row.get(name, default) for name, default in fields} for row in rows]
+
+def response(content) -> Response:
+    # OPT_UTC_Z writes UTC as "Z" like pydantic does
+    return Response(orjson.dumps(content, option=orjson.OPT_UTC_Z), media_type='application/json')
@@ -1,30 +1,72 @@
-import psycopg2
 import os
+import asyncio
+from contextlib import asynccontextmanager
+from time import perf_counter
 from loguru import logger
+from psycopg import AsyncConnection, OperationalError
+from psycopg_pool import AsyncConnectionPool
+from session_store import SessionStore, MemorySessionStore, PostgresSessionStore
+import metrics
 
-conn = psycopg2.connect(os.environ['DB_PATH'])
-cur = conn.cursor()
+pool = AsyncConnectionPool(os.environ['DB_PATH'],
+                           min_size=int(os.environ.get('DB_POOL_MIN', '2')),
+                           max_size=int(os.environ.get('DB_POOL_MAX', '10')),
+                           timeout=float(os.environ.get('DB_POOL_TIMEOUT', '10')),
+                           max_idle=float(os.environ.get('DB_POOL_MAX_IDLE', '300')),
+                           # Ping connections on checkout, so ones dropped by the server are replaced, not used
+                           check=AsyncConnectionPool.check_connection,
+                           open=False)
+DB_CONNECT_ATTEMPTS = int(os.environ.get('DB_CONNECT_ATTEMPTS', '10'))  # on startup, with backoff up to 30 s
 
-cur.execute("SELECT version();")
+async def open_pool():
+    """Wait until Postgres accepts connections, then open connections of the pool.
+    Must be called inside the running event loop. Raises if Postgres is still unavailable after DB_CONNECT_ATTEMPTS"""
+    delay = 0.5
+    for attempt in range(1, DB_CONNECT_ATTEMPTS + 1):
+        # Probe with a separate connection: a pool that failed to open cannot be opened again
+        try:
+            async with await AsyncConnection.connect(os.environ['DB_PATH'], connect_timeout=10) as conn:
+                cur = await conn.execute("SELECT version();")
+                logger.info(await cur.fetchone())
+            break
+        except OperationalError as e:
+            if attempt == DB_CONNECT_ATTEMPTS:
+                raise
+            logger.warning(f'Postgres is unavailable, retrying in {delay} s: {e}')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+    await pool.open(wait=True)
 
-logger.info(cur.fetchone())
-cur.close()
+async def close_pool():
+    await pool.close()
 
 def get_conn():
-    global conn
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute('SELECT 1')
-    except (psycopg2.InterfaceError, psycopg2.OperationalError):
-        logger.warning('Connection to DB has been closed by server. Reconnecting...')
-        if conn:
-            try:
-                conn.close()
-            except:
-                pass
-        conn = psycopg2.connect(os.environ['DB_PATH'])
-        logger.success('Connected to DB!')
-    return conn
+    """Check out a connection for the duration of `async with` block.
+    The transaction is committed on exit and rolled back if an exception was raised.
+    Waits at most DB_POOL_TIMEOUT seconds for a free connection"""
+    if metrics.sampled():
+        return _timed_connection()
+    return pool.connection()
 
-sessions = {}
\ No newline at end of file
+@asynccontextmanager
+async def _timed_connection():
+    start = perf_counter()
+    async with pool.connection() as conn:
+        metrics.record(metrics.conn_wait, start)
+        yield conn
+
+def pool_stats():
+    """Current pool usage: in-use and idle connections, waiting requests and total wait time"""
+    stats = pool.get_stats()
+    size, idle = stats.get('pool_size', 0), stats.get('pool_available', 0)
+    return {'min': stats.get('pool_min'), 'max': stats.get('pool_max'),
+            'in_use': size - idle, 'idle': idle,
+            'waiting': stats.get('requests_waiting', 0),
+            'requests': stats.get('requests_num', 0),
+            'wait_ms': stats.get('requests_wait_ms', 0),
+            'errors': stats.get('requests_errors', 0)}
+
+SESSION_TTL = float(os.environ.get('SESSION_TTL', str(7 * 24 * 3600)))
+SESSION_PURGE_INTERVAL = float(os.environ.get('SESSION_PURGE_INTERVAL', '600'))
+sessions: SessionStore = PostgresSessionStore(SESSION_TTL, pool) \
+    if os.environ.get('SESSION_STORE', 'memory') == 'postgres' else MemorySessionStore(SESSION_TTL)
@@ -0,0 +1,53 @@
+"""Password hashing in a separate process pool, so logins do not block the event loop.
+Pool processes are started by forkserver (spawn on Windows), never forked from the worker, which already runs
+threads (storage pool, DB pool) and could deadlock in the child. So this module is imported again by every pool
+process: keep it free of DB/Dropbox imports"""
+import os
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from passlib.hash import pbkdf2_sha256
+from utils import Exception503
+import metrics
+
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', str(os.cpu_count() or 1)))
+HASH_QUEUE = int(os.environ.get('HASH_QUEUE', str(HASH_WORKERS * 4)))  # max hashes running or waiting
+HASH_ROUNDS = int(os.environ.get('HASH_ROUNDS', str(pbkdf2_sha256.default_rounds)))
+SALT = os.environ.get('SALT', '')
+
+_hasher = pbkdf2_sha256.using(rounds=HASH_ROUNDS)
+_executor = ProcessPoolExecutor(HASH_WORKERS, mp_context=multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'))
+_pending = 0
+
+
+def _hash(password):
+    return _hasher.hash(password + SALT)
+
+def _verify(password, hashed):
+    if not _hasher.verify(password + SALT, hashed):
+        return False, None
+    # Rounds were changed since password was hashed, so hash it again while we know the password
+    return True, _hasher.hash(password + SALT) if _hasher.needs_update(hashed) else None
+
+async def _submit(func, *args):
+    """Run func in the pool. Rejects work right away when HASH_QUEUE hashes are already pending"""
+    global _pending
+    if _pending >= HASH_QUEUE:
+        raise Exception503('Too many login attempts, try again later')
+    _pending += 1
+    try:
+        with metrics.span(metrics.hashing, func.__name__.lstrip('_')):
+            return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+    finally:
+        _pending -= 1
+
+async def hash_password(password: str) -> str:
+    return await _submit(_hash, password)
+
+async def verify_password(password: str, hashed: str) -> tuple[bool, str | None]:
+    """Returns whether password is correct and new hash if stored one uses outdated settings"""
+    return await _submit(_verify, password, hashed)
+
+def shutdown():
+    _executor.shutdown(cancel_futures=True)
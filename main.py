@@ -1,20 +1,65 @@
 from loguru import logger
 import os
+import asyncio
 import uvicorn
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import JSONResponse, HTMLResponse, PlainTextResponse
 from fastapi.requests import Request
 from fastapi.middleware.cors import CORSMiddleware
 
 import box_api
 from routes import auth, storage
-from utils import Exception400
+from globals import open_pool, close_pool, pool_stats, get_conn, pool, sessions, SESSION_PURGE_INTERVAL
+from utils import Exception400, Exception503
+import hashing
+import votes
+import metrics
+import content_encoding
 
-try:
-    box_api.login('')
-    logger.info('Dropbox has been authorized')
-except:
-    logger.info('Please open "/dbx" page')
+# Memory sessions are not shared between workers, so several workers are used by default only with Postgres ones
+WORKERS = int(os.environ.get('WORKERS', str(os.cpu_count() or 1)
+                             if os.environ.get('SESSION_STORE', 'memory') == 'postgres' else '1'))
+SHUTDOWN_TIMEOUT = float(os.environ.get('SHUTDOWN_TIMEOUT', '30'))  # seconds to finish in-flight requests
+DBX_TOKEN_POLL_INTERVAL = 5  # seconds between checks for a token saved by /dbx page of another worker
+
+
+async def login_dropbox():
+    """Background task. Logs into Dropbox with the saved token, retrying network errors with backoff.
+    Without a token waits until /dbx page is used (by this or another worker) and saves one.
+    Routes that do not touch storage work meanwhile"""
+    delay = 1
+    if not box_api.authorized() and box_api.saved_token() is None:
+        logger.info('Please open "/dbx" page')
+    while not box_api.authorized():
+        if box_api.saved_token() is None:
+            await asyncio.sleep(DBX_TOKEN_POLL_INTERVAL)
+            continue
+        try:
+            await asyncio.to_thread(box_api.login, '')
+        except Exception as e:
+            logger.warning(f'Dropbox login failed: {e}')
+        if box_api.authorized():
+            logger.info('Dropbox has been authorized')
+            return
+        logger.info(f'Retrying Dropbox login in {delay} s')
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 60)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    await open_pool()
+    await votes.recover()
+    tasks = [asyncio.create_task(sessions.purge_forever(SESSION_PURGE_INTERVAL)),
+             asyncio.create_task(votes.flush_forever()),
+             asyncio.create_task(login_dropbox())]
+    yield
+    for task in tasks:
+        task.cancel()
+    await votes.flush()
+    hashing.shutdown()
+    await close_pool()
 
 app = FastAPI(
     title="StoryForge",
@@ -23,12 +68,14 @@ app = FastAPI(
     contact={
         'name': 'GitHub repository',
         'url': 'https://github.com/Moohomor/sf-fastapi'
-    }
+    },
+    lifespan=lifespan
 )
 app.include_router(auth.auth_router)
 app.include_router(storage.storage_router)
 # app.include_router(ai_routes.ai_router)
 
+app.add_middleware(content_encoding.CompressionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=['*'],
@@ -36,10 +83,16 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(metrics.MetricsMiddleware)
 
 
+# Exception400/503 are registered separately, so they are handled inside middlewares and their status is seen there
+@app.exception_handler(Exception400)
+@app.exception_handler(Exception503)
 @app.exception_handler(Exception)
 async def handle_500(_: Request, ex: Exception):
+    if isinstance(ex, Exception503):
+        return JSONResponse({'result': str(ex)}, 503, headers={'Retry-After': '1'})
     return JSONResponse({'result': str(ex)
                         if os.environ.get('SHOW_EXCEPTIONS', '0') == '1' else 'ERROR'},
                         400 if isinstance(ex, Exception400) else 500)
@@ -49,6 +102,41 @@ async def handle_500(_: Request, ex: Exception):
 async def ping():
     return 'pong'
 
+@app.get('/health/live')
+async def live():
+    """The worker is running and its event loop responds"""
+    return {'status': 'ok'}
+
+@app.get('/health/ready')
+async def ready():
+    """The worker can serve requests: Postgres answers. 503 otherwise.
+    Storage is reported but does not affect readiness, so /dbx stays reachable when Dropbox is not authorized"""
+    status = {'db': 'ok', 'storage': 'ok' if box_api.authorized() else 'not authorized'}
+    try:
+        async with asyncio.timeout(2):
+            async with get_conn() as conn:
+                await conn.execute('SELECT 1')
+    except Exception as e:
+        status['db'] = 'closed' if pool.closed else type(e).__name__
+        return JSONResponse(status, 503)
+    return status
+
+@app.get('/stats')
+async def stats():
+    """Resource usage of this worker. Use it to size DB_POOL_MIN/DB_POOL_MAX and CACHE_MAX_BYTES"""
+    return {'db_pool': pool_stats(), 'cache': box_api.cache.stats()}
+
+@app.get('/metrics', response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Metrics of this worker in Prometheus text format. See METRICS_SAMPLE_RATE"""
+    db, cache = pool_stats(), box_api.cache.stats()
+    gauges = {f'db_pool_{k}': db[k] for k in ('min', 'max', 'in_use', 'idle', 'waiting')}
+    gauges |= {f'cache_{k}': cache[k] for k in ('entries', 'bytes', 'max_bytes', 'disk_bytes')}
+    counters = {'db_pool_requests_total': db['requests'], 'db_pool_errors_total': db['errors'],
+                'db_pool_wait_seconds_total': db['wait_ms'] / 1000}
+    counters |= {f'cache_{k}_total': cache[k] for k in ('hits', 'misses', 'evictions', 'disk_hits')}
+    return PlainTextResponse(metrics.render(gauges, counters), media_type='text/plain; version=0.0.4')
+
 @app.get('/dbx')
 def dropbox_auth_page() -> HTMLResponse:
     """Get Dropbox authorization instructions"""
@@ -71,4 +159,10 @@ def get_dropbox_token_page(token: str):
 
 
 if __name__ == '__main__':
-    uvicorn.run(app, host='0.0.0.0', port=int(os.environ.get('PORT', '8000')))
\ No newline at end of file
+    if WORKERS > 1 and os.environ.get('SESSION_STORE', 'memory') == 'memory':
+        logger.warning('Every worker has its own sessions with SESSION_STORE=memory, '
+                       'so users get logged out randomly. Use SESSION_STORE=postgres')
+    # Workers inherit environment. Share cores between their password hashing pools instead of multiplying them
+    os.environ.setdefault('HASH_WORKERS', str(max(1, (os.cpu_count() or 1) // WORKERS)))
+    uvicorn.run('main:app', host='0.0.0.0', port=int(os.environ.get('PORT', '8000')), workers=WORKERS,
+                timeout_graceful_shutdown=SHUTDOWN_TIMEOUT)
\ No newline at end of file
@@ -0,0 +1,142 @@
+"""Request latency histograms and timing spans, exposed in Prometheus text format on /metrics.
+Every request is counted and timed. Spans inside a request (connection checkout, DB statements, storage calls,
+password hashing) are timed only for METRICS_SAMPLE_RATE share of requests, so their cost on the hot path stays
+negligible. Work outside of requests (background tasks) is not timed. Values are kept per worker process"""
+import os
+from bisect import bisect_left
+from contextvars import ContextVar
+from random import random
+from time import perf_counter
+
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '0.1'))  # 0 turns spans off, 1 times every request
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)  # seconds
+PREFIX = 'storyforge_'
+
+_sampled: ContextVar[bool] = ContextVar('metrics_sampled', default=False)
+_metrics: list['Counter | Histogram'] = []
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{n}="{str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')}"'
+             for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name, self.help, self.labels = PREFIX + name, help, labels
+        self._values: dict[tuple, float] = {}
+        _metrics.append(self)
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        for values, v in self._values.items():
+            yield f'{self.name}{_labels(self.labels, values)} {v}'
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name, self.help, self.labels = PREFIX + name, help, labels
+        # label values -> observations per bucket (last one is +Inf), then sum and count
+        self._series: dict[tuple, list] = {}
+        _metrics.append(self)
+
+    def observe(self, seconds: float, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [0] * (len(BUCKETS) + 1) + [0.0, 0]
+        series[bisect_left(BUCKETS, seconds)] += 1
+        series[-2] += seconds
+        series[-1] += 1
+
+    def samples(self):
+        for values, series in self._series.items():
+            total = 0
+            for bound, n in zip((*BUCKETS, '+Inf'), series):
+                total += n
+                yield f'{self.name}_bucket{_labels(self.labels, values, f'le="{bound}"')} {total}'
+            yield f'{self.name}_sum{_labels(self.labels, values)} {series[-2]}'
+            yield f'{self.name}_count{_labels(self.labels, values)} {series[-1]}'
+
+
+class _Span:
+    __slots__ = ('histogram', 'label_values', 'start')
+
+    def __init__(self, histogram, label_values):
+        self.histogram, self.label_values = histogram, label_values
+
+    def __enter__(self):
+        self.start = perf_counter() if _sampled.get() else None
+
+    def __exit__(self, *exc):
+        if self.start is not None:
+            self.histogram.observe(perf_counter() - self.start, *self.label_values)
+
+def span(histogram: Histogram, *label_values) -> _Span:
+    """`with span(...)` times the block if the current request is sampled"""
+    return _Span(histogram, label_values)
+
+def sampled() -> bool:
+    """Whether spans of the current request are timed"""
+    return _sampled.get()
+
+def record(histogram: Histogram, start: float, *label_values):
+    """Observe time since `start` (perf_counter) if the current request is sampled"""
+    if _sampled.get():
+        histogram.observe(perf_counter() - start, *label_values)
+
+
+requests = Histogram('request_duration_seconds', 'Time to handle a request', ('method', 'route'))
+responses = Counter('responses_total', 'Responses by status code', ('method', 'route', 'status'))
+conn_wait = Histogram('db_connection_wait_seconds', 'Time to check out a connection from the pool')
+statements = Histogram('db_statement_seconds', 'Time to execute a statement and fetch its rows', ('statement',))
+storage_calls = Histogram('storage_call_seconds', 'Time of a storage backend call, including thread pool queue',
+                          ('call',))
+hashing = Histogram('password_hash_seconds', 'Time to hash or verify a password, including queue', ('operation',))
+
+
+class MetricsMiddleware:
+    """Times every HTTP request by route template and decides whether its spans are sampled"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        status = 500
+        token = _sampled.set(METRICS_SAMPLE_RATE > 0 and random() < METRICS_SAMPLE_RATE)
+        start = perf_counter()
+
+        async def send_and_record_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            _sampled.reset(token)
+            route = scope.get('route')
+            path = route.path if route is not None else 'unmatched'  # not raw path: ids would explode series
+            requests.observe(perf_counter() - start, scope['method'], path)
+            responses.inc(scope['method'], path, status)
+
+
+def render(gauges: dict[str, float], counters: dict[str, float]) -> str:
+    """All metrics in Prometheus text format. gauges and counters are current values read by the caller"""
+    lines = []
+    for name, value in gauges.items():
+        lines += [f'# TYPE {PREFIX}{name} gauge', f'{PREFIX}{name} {value}']
+    for name, value in counters.items():
+        lines += [f'# TYPE {PREFIX}{name} counter', f'{PREFIX}{name} {value}']
+    for metric in _metrics:
+        lines += [f'# HELP {metric.name} {metric.help}', f'# TYPE {metric.name} {metric.type}', *metric.samples()]
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,9 @@
+-- Sessions shared by all workers (SESSION_STORE=postgres)
+CREATE TABLE IF NOT EXISTS sf.sessions (
+    sid text PRIMARY KEY,
+    uid integer NOT NULL,
+    name text NOT NULL,
+    started timestamptz NOT NULL DEFAULT now(),
+    expires timestamptz NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_expires_idx ON sf.sessions (expires);
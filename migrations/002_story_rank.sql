@@ -0,0 +1,19 @@
+-- Precomputed ranking of the home feed and indexes for every list_stories ordering
+ALTER TABLE sf.stories ADD COLUMN IF NOT EXISTS rank double precision;
+
+CREATE OR REPLACE FUNCTION sf.story_rank() RETURNS trigger AS $$
+BEGIN
+    NEW.rank := power((NEW.votes + 1) * cast(extract(epoch from NEW.updated_at) as BigInt), 2);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS stories_rank ON sf.stories;
+CREATE TRIGGER stories_rank BEFORE INSERT OR UPDATE OF votes, updated_at ON sf.stories
+    FOR EACH ROW EXECUTE FUNCTION sf.story_rank();
+
+UPDATE sf.stories SET rank = power((votes + 1) * cast(extract(epoch from updated_at) as BigInt), 2);
+
+CREATE INDEX IF NOT EXISTS stories_home_idx ON sf.stories (rank DESC, id DESC);
+CREATE INDEX IF NOT EXISTS stories_best_idx ON sf.stories (votes DESC, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS stories_user_idx ON sf.stories (author, updated_at DESC, id DESC);
@@ -0,0 +1,3 @@
+-- Index-only sampling of public stories for /storage/random_story
+CREATE INDEX IF NOT EXISTS stories_public_id_idx ON sf.stories (id) WHERE NOT private;
+CREATE INDEX IF NOT EXISTS reviews_story_idx ON sf.reviews (story);
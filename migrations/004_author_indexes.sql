@@ -0,0 +1,2 @@
+-- Grouped lookups of user's reviews for /storage/users_by_ids
+CREATE INDEX IF NOT EXISTS reviews_author_idx ON sf.reviews (author);
@@ -0,0 +1,5 @@
+-- Ids of vote batches already written by votes.flush, so a batch replayed after crash is not counted twice
+CREATE TABLE IF NOT EXISTS sf.vote_batches (
+    id text PRIMARY KEY,
+    applied_at timestamptz NOT NULL DEFAULT now()
+);
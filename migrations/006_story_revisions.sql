@@ -0,0 +1,11 @@
+-- History of story content (see revisions.py). Revision 0 is stories/{id}.xml and has no row.
+-- ops: edits against the previous revision, NULL when the whole content was uploaded.
+-- snapshot: whole content of this revision is stored at stories/{id}/{rev}.xml
+CREATE TABLE IF NOT EXISTS sf.story_revisions (
+    story integer NOT NULL REFERENCES sf.stories (id) ON DELETE CASCADE,
+    rev integer NOT NULL,
+    ops jsonb,
+    snapshot boolean NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (story, rev)
+);
@@ -0,0 +1,26 @@
+-- Full-text search over story names and content (see search.py).
+-- Kept apart from sf.stories, so story queries selecting s.* do not carry the vectors.
+-- Names are indexed by trigger, content lives in storage and is indexed by the app when it is saved
+CREATE TABLE IF NOT EXISTS sf.story_search (
+    story integer PRIMARY KEY REFERENCES sf.stories (id) ON DELETE CASCADE,
+    name tsvector NOT NULL DEFAULT ''::tsvector,
+    content tsvector NOT NULL DEFAULT ''::tsvector,
+    document tsvector GENERATED ALWAYS AS (setweight(name, 'A') || setweight(content, 'B')) STORED
+);
+CREATE INDEX IF NOT EXISTS story_search_idx ON sf.story_search USING gin (document);
+
+CREATE OR REPLACE FUNCTION sf.story_search_name() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO sf.story_search (story, name) VALUES (NEW.id, to_tsvector('simple', NEW.name))
+    ON CONFLICT (story) DO UPDATE SET name = excluded.name;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS stories_search ON sf.stories;
+CREATE TRIGGER stories_search AFTER INSERT OR UPDATE OF name ON sf.stories
+    FOR EACH ROW EXECUTE FUNCTION sf.story_search_name();
+
+INSERT INTO sf.story_search (story, name) SELECT id, to_tsvector('simple', name) FROM sf.stories
+ON CONFLICT (story) DO UPDATE SET name = excluded.name;
+-- Content of existing stories is indexed by: python search.py
@@ -0,0 +1,178 @@
+"""All SQL statements of the app and helpers to run them.
+Statements are parameterized and constant, so every connection prepares each of them once and then
+only binds parameters. Rows are mapped with psycopg row factories, which read column names once per result"""
+from collections import OrderedDict
+from time import time
+from psycopg import AsyncConnection
+from psycopg.rows import tuple_row, dict_row, class_row
+from globals import get_conn
+import metrics
+
+# Evaluated only for rows that are returned, so LIMIT is applied before reviews are collected
+REVIEW_IDS = "coalesce((SELECT array_agg(id ORDER BY id) FROM sf.reviews WHERE story=s.id), '{}') AS reviews"
+
+USER_INSERT = "INSERT INTO sf.users (name, password) VALUES (%s, %s)"
+USER_LOGIN = "SELECT password, id FROM sf.users WHERE name=%s"
+USER_SET_PASSWORD = "UPDATE sf.users SET password=%s WHERE id=%s"
+USER_NAME = "SELECT name FROM sf.users WHERE id=%s"
+USER_NAMES = "SELECT id, name FROM sf.users WHERE id = ANY(%s)"
+# author -> ids of user's stories/reviews, one grouped query for all authors
+STORY_IDS_BY_AUTHOR = "SELECT author, array_agg(id ORDER BY id) FROM sf.stories WHERE author = ANY(%s) GROUP BY author"
+REVIEW_IDS_BY_AUTHOR = "SELECT author, array_agg(id ORDER BY id) FROM sf.reviews WHERE author = ANY(%s) GROUP BY author"
+
+STORY_BY_ID = "SELECT s.* FROM sf.stories s WHERE s.id=%s"
+STORY_BY_ID_DETAILED = f"SELECT s.*, {REVIEW_IDS} FROM sf.stories s WHERE s.id=%s"
+# Private stories are returned only to their author (second parameter)
+STORIES_BY_IDS = "SELECT s.* FROM sf.stories s WHERE s.id = ANY(%s) AND (NOT private OR author = %s)"
+STORIES_BY_IDS_DETAILED = (f"SELECT s.*, {REVIEW_IDS} FROM sf.stories s "
+                           "WHERE s.id = ANY(%s) AND (NOT private OR author = %s)")
+STORY_INSERT = "INSERT INTO sf.stories (name, author) VALUES (%s, %s) RETURNING *"
+STORY_OWNER = "SELECT author, private FROM sf.stories WHERE id=%s"
+STORY_SET_PRIVATE = "UPDATE sf.stories SET private=%s WHERE id=%s"
+STORY_SET_NAME = "UPDATE sf.stories SET name=%s WHERE id=%s"
+
+# Picks random points between min and max public id and takes the next public story after each of them,
+# wrapping around to the first one. Every step is an index lookup, so it does not depend on the number of stories.
+# Stories right after big gaps in ids are picked a bit more often, which is fine for "random story" button.
+# Parameters: number of points, ids to skip (already picked), the same ids again
+RANDOM_STORIES = f"""
+WITH bounds AS (SELECT min(id) AS lo, max(id) AS hi FROM sf.stories WHERE NOT private),
+points AS (SELECT lo + floor(random() * (hi - lo + 1))::bigint AS point
+           FROM bounds, generate_series(1, %s) WHERE lo IS NOT NULL)
+SELECT DISTINCT ON (s.id) s.*, {REVIEW_IDS}
+FROM points CROSS JOIN LATERAL (
+    SELECT * FROM ((SELECT * FROM sf.stories WHERE NOT private AND id >= points.point AND id <> ALL(%s::int[])
+                    ORDER BY id LIMIT 1)
+                   UNION ALL
+                   (SELECT * FROM sf.stories WHERE NOT private AND id <> ALL(%s::int[]) ORDER BY id LIMIT 1)) t
+    LIMIT 1) s
+"""
+
+# Sort keys of every listing, all descending. rank is maintained by trigger (see migrations/002_story_rank.sql)
+STORY_ORDER = {
+    'best': ('votes', 'created_at', 'id'),
+    'home': ('rank', 'id'),
+    'user': ('updated_at', 'id')
+}
+
+def _list_stories(listing, with_cursor):
+    conditions = ['author=%s'] if listing == 'user' else ['true']
+    keys = STORY_ORDER[listing]
+    if with_cursor:
+        conditions.append(f"({', '.join(keys)}) < ({', '.join(['%s'] * len(keys))})")
+    return (f"SELECT s.*, {REVIEW_IDS} FROM sf.stories s WHERE {' AND '.join(conditions)} "
+            f"ORDER BY {', '.join(f'{k} DESC' for k in keys)} LIMIT %s OFFSET %s")
+
+# (listing type, whether cursor is given) -> statement. Parameters: [author], [cursor values], limit, offset
+LIST_STORIES = {(listing, with_cursor): _list_stories(listing, with_cursor)
+                for listing in STORY_ORDER for with_cursor in (False, True)}
+
+REVIEW_BY_ID = "SELECT * FROM sf.reviews WHERE id=%s"
+REVIEWS_BY_IDS = "SELECT * FROM sf.reviews WHERE id = ANY(%s)"
+REVIEW_INSERT = "INSERT INTO sf.reviews (author, story, content) VALUES (%s, %s, %s) RETURNING *"
+
+# Matches of a websearch-style query ("quoted phrases", -excluded words, or), best first.
+# Parameters: query, uid of the session (private stories are found only by their author), limit, offset
+SEARCH_STORIES = f"""
+WITH query AS (SELECT websearch_to_tsquery('simple', %s) AS q)
+SELECT s.*, {REVIEW_IDS}
+FROM query, sf.story_search f JOIN sf.stories s ON s.id = f.story
+WHERE f.document @@ query.q AND (NOT s.private OR s.author = %s)
+ORDER BY ts_rank(f.document, query.q) DESC, s.id DESC LIMIT %s OFFSET %s
+"""
+SEARCH_INDEX_CONTENT = ("INSERT INTO sf.story_search (story, content) VALUES (%s, to_tsvector('simple', %s)) "
+                        "ON CONFLICT (story) DO UPDATE SET content = excluded.content")
+ALL_STORY_IDS = "SELECT id FROM sf.stories ORDER BY id"
+
+# A row without ops that is not a snapshot yet is a whole-content save still uploading (see revisions.save)
+REVISION_LATEST = ("SELECT rev, created_at FROM sf.story_revisions WHERE story=%s AND (ops IS NOT NULL OR snapshot) "
+                   "ORDER BY rev DESC LIMIT 1")
+REVISION_SNAPSHOT = "SELECT coalesce(max(rev), 0) FROM sf.story_revisions WHERE story=%s AND rev <= %s AND snapshot"
+REVISION_OPS = "SELECT ops FROM sf.story_revisions WHERE story=%s AND rev > %s AND rev <= %s ORDER BY rev"
+REVISION_INSERT = "INSERT INTO sf.story_revisions (story, rev, ops, snapshot) VALUES (%s, %s, %s, false)"
+REVISION_MARK_SNAPSHOT = "UPDATE sf.story_revisions SET snapshot = true WHERE story=%s AND rev=%s"
+# Rows before the oldest kept snapshot. Returns them, so snapshot files can be deleted after commit
+REVISION_PRUNE = ("WITH oldest AS (SELECT rev FROM sf.story_revisions WHERE story=%s AND snapshot "
+                  "ORDER BY rev DESC LIMIT 1 OFFSET %s) "
+                  "DELETE FROM sf.story_revisions r USING oldest WHERE r.story=%s AND r.rev < oldest.rev "
+                  "RETURNING r.rev, r.snapshot")
+REVISION_DROP_PENDING = ("DELETE FROM sf.story_revisions WHERE story=%s AND rev=%s AND ops IS NULL AND NOT snapshot "
+                         "AND created_at < now() - make_interval(secs => %s)")
+
+VOTES = {table: f"SELECT votes FROM sf.{table} WHERE id=%s" for table in ('stories', 'reviews')}
+ADD_VOTES = {table: f"UPDATE sf.{table} t SET votes = t.votes + v.delta "
+                    "FROM unnest(%s::int[], %s::int[]) AS v(id, delta) WHERE t.id = v.id"
+             for table in ('stories', 'reviews')}
+VOTE_BATCH_INSERT = "INSERT INTO sf.vote_batches (id) VALUES (%s) ON CONFLICT DO NOTHING"
+VOTE_BATCHES_PURGE = "DELETE FROM sf.vote_batches WHERE applied_at < now() - interval '7 days'"
+
+
+def _names(**constants):
+    """Statement text -> name of its constant, used as label of metrics"""
+    names = {}
+    for name, value in constants.items():
+        if name.isupper() and isinstance(value, str):
+            names[value] = name
+        elif name.isupper() and isinstance(value, dict):
+            for key, sql in value.items():
+                if isinstance(sql, str):
+                    names[sql] = '_'.join([name, *map(str, key if isinstance(key, tuple) else (key,))])
+    return names
+
+STATEMENT_NAMES = _names(**globals())
+
+
+def _row_factory(row_type):
+    if row_type is None:
+        return tuple_row
+    if row_type is dict:
+        return dict_row
+    return class_row(row_type)
+
+async def fetch_all(conn: AsyncConnection, sql: str, params=(), row_type=None) -> list:
+    """Rows of prepared statement: tuples, dicts (row_type=dict) or instances of row_type made from columns"""
+    with metrics.span(metrics.statements, STATEMENT_NAMES.get(sql, 'other')):
+        async with conn.cursor(row_factory=_row_factory(row_type)) as cur:
+            await cur.execute(sql, params, prepare=True)
+            return await cur.fetchall()
+
+async def fetch_one(conn: AsyncConnection, sql: str, params=(), row_type=None):
+    """First row of prepared statement or None. See fetch_all"""
+    with metrics.span(metrics.statements, STATEMENT_NAMES.get(sql, 'other')):
+        async with conn.cursor(row_factory=_row_factory(row_type)) as cur:
+            await cur.execute(sql, params, prepare=True)
+            return await cur.fetchone()
+
+async def execute(conn: AsyncConnection, sql: str, params=()) -> int:
+    """Run prepared statement. Returns number of affected rows"""
+    with metrics.span(metrics.statements, STATEMENT_NAMES.get(sql, 'other')):
+        async with conn.cursor() as cur:
+            await cur.execute(sql, params, prepare=True)
+            return cur.rowcount
+
+
+OWNER_CACHE_TTL = 30  # seconds. Privacy changed by other workers is noticed after this time
+OWNER_CACHE_SIZE = 10000
+_owners: OrderedDict[int, tuple[int, bool, float]] = OrderedDict()
+
+
+async def story_owner(story_id: int) -> tuple[int, bool] | None:
+    """Author and privacy of the story for permission checks, None if there is no such story"""
+    cached = _owners.get(story_id)
+    if cached is not None and time() - cached[2] < OWNER_CACHE_TTL:
+        return cached[0], cached[1]
+    async with get_conn() as conn:
+        row = await fetch_one(conn, STORY_OWNER, (story_id,))
+    if row is None:
+        _owners.pop(story_id, None)
+        return None
+    _owners[story_id] = row[0], row[1], time()
+    _owners.move_to_end(story_id)
+    if len(_owners) > OWNER_CACHE_SIZE:
+        _owners.popitem(last=False)
+    return row[0], row[1]
+
+
+def forget_story(story_id: int):
+    """Call after changing author/privacy of the story or deleting it"""
+    _owners.pop(story_id, None)
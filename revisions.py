@@ -0,0 +1,127 @@
+"""Story content history. Every save gets the next revision number.
+Saves made of edits are kept in sf.story_revisions as a list of edits against the previous revision, and only every
+REVISION_SNAPSHOT_EVERY revisions the whole content is written to storage as a snapshot. Whole-content uploads are
+always snapshots. Revision 0 is stories/{id}.xml written by new_story (see migrations/006_story_revisions.sql).
+No DB connection is held while a snapshot is uploaded: the row is committed first and marked as a snapshot after.
+Until then a whole-content row (no ops) is pending and readers do not see it.
+Only the latest REVISION_KEEP_SNAPSHOTS snapshots are kept: older revisions are deleted with their files"""
+import os
+from datetime import datetime
+from loguru import logger
+from psycopg.errors import UniqueViolation
+from psycopg.types.json import Jsonb
+import box_api
+from cache import ByteCache
+from globals import get_conn
+import queries as q
+from queries import fetch_one, fetch_all, execute
+from utils import Exception400
+
+REVISION_SNAPSHOT_EVERY = int(os.environ.get('REVISION_SNAPSHOT_EVERY', '50'))
+REVISION_KEEP_SNAPSHOTS = max(1, int(os.environ.get('REVISION_KEEP_SNAPSHOTS', '10')))
+PENDING_TIMEOUT = 2 * box_api.DBX_TIMEOUT  # seconds after which a pending row of a crashed save is dropped
+# Texts of recent revisions, so an autosave does not rebuild its base revision from snapshot and edits
+_texts = ByteCache(max_bytes=int(os.environ.get('REVISION_CACHE_BYTES', str(16 * 2**20))),
+                   max_item_bytes=int(os.environ.get('CACHE_MAX_ITEM_BYTES', str(4 * 2**20))))
+
+Op = tuple[int, int, str]  # position, number of deleted characters, inserted text
+
+
+def story_path(story_id: int, rev: int) -> str:
+    if rev == 0:
+        return f'{os.environ['STORAGE_PREFIX']}/stories/{story_id}.xml'
+    return f'{os.environ['STORAGE_PREFIX']}/stories/{story_id}/{rev}.xml'
+
+def apply(text: str, ops: list[Op]) -> str:
+    """Apply edits one after another. Positions are in characters (code points) of the text at that moment"""
+    for pos, delete, insert in ops:
+        if pos < 0 or delete < 0 or pos + delete > len(text):
+            raise Exception400('Edit is out of bounds')
+        text = text[:pos] + insert + text[pos + delete:]
+    return text
+
+
+async def latest(story_id: int) -> tuple[int, datetime | None]:
+    """Number and save time of the latest revision. Time is None for revision 0"""
+    async with get_conn() as conn:
+        row = await fetch_one(conn, q.REVISION_LATEST, (story_id,))
+    return (0, None) if row is None else (row[0], row[1])
+
+async def content(story_id: int, rev: int) -> str:
+    """Text of the revision: the nearest snapshot with the edits made after it"""
+    key = f'{story_id}.{rev}'
+    if (cached := _texts.get(key)) is not None:
+        return cached.decode()
+    async with get_conn() as conn:
+        snapshot = (await fetch_one(conn, q.REVISION_SNAPSHOT, (story_id, rev)))[0]
+        edits = await fetch_all(conn, q.REVISION_OPS, (story_id, snapshot, rev))
+    if len(edits) != rev - snapshot:
+        raise Exception400(f'Revision {rev} is no longer kept')
+    text = await box_api.file_content(story_path(story_id, snapshot))
+    for (ops,) in edits:
+        text = apply(text, ops)
+    _texts.put(key, text.encode(), _texts.token())
+    return text
+
+async def delta(story_id: int, since: int, rev: int) -> list[Op] | None:
+    """Edits turning revision `since` into `rev`, None if a whole-content upload was made in between
+    or `since` is no longer kept"""
+    async with get_conn() as conn:
+        edits = await fetch_all(conn, q.REVISION_OPS, (story_id, since, rev))
+    if len(edits) != rev - since or any(ops is None for (ops,) in edits):
+        return None
+    return [op for (ops,) in edits for op in ops]
+
+async def _prune(story_id: int):
+    """Delete revisions older than the oldest of the latest REVISION_KEEP_SNAPSHOTS snapshots.
+    Revision 0 (stories/{id}.xml) is kept. Failures are logged: pruning is retried by the next snapshot"""
+    try:
+        async with get_conn() as conn:
+            pruned = await fetch_all(conn, q.REVISION_PRUNE, (story_id, REVISION_KEEP_SNAPSHOTS - 1, story_id))
+        files = [story_path(story_id, rev) for rev, snapshot in pruned if snapshot]
+        if files:
+            errors = await box_api.delete_many(files)
+            for file, error in zip(files, errors):
+                if error is not None and error != 'Not found':
+                    logger.warning(f'Could not delete old snapshot {file}: {error}')
+    except Exception:
+        logger.exception(f'Failed to prune revisions of story {story_id}')
+
+async def save(story_id: int, text: str | None = None, ops: list[Op] | None = None,
+               base_rev: int | None = None) -> tuple[int, str]:
+    """Save whole text or edits against base_rev. Fails if base_rev is given and is not the latest revision.
+    Returns the new revision number and its text"""
+    latest_rev, _ = await latest(story_id)
+    if base_rev is not None and base_rev != latest_rev:
+        raise Exception400(f'Story was changed since revision {base_rev}, latest revision is {latest_rev}')
+    rev = latest_rev + 1
+    snapshot = ops is None
+    if ops is not None:
+        text = apply(await content(story_id, latest_rev), ops)
+        async with get_conn() as conn:
+            last_snapshot = (await fetch_one(conn, q.REVISION_SNAPSHOT, (story_id, latest_rev)))[0]
+        snapshot = rev - last_snapshot >= REVISION_SNAPSHOT_EVERY
+    async with get_conn() as conn:
+        # Reserving the revision makes a concurrent save of the same revision fail instead of overwriting its snapshot
+        await execute(conn, q.REVISION_DROP_PENDING, (story_id, rev, PENDING_TIMEOUT))
+        try:
+            await execute(conn, q.REVISION_INSERT, (story_id, rev, None if ops is None else Jsonb(ops)))
+        except UniqueViolation:
+            raise Exception400(f'Story was changed since revision {latest_rev}')
+    if snapshot:
+        try:
+            await box_api.upload(text.encode(), story_path(story_id, rev))
+        except Exception:
+            if ops is None:  # nothing to read this revision from
+                async with get_conn() as conn:
+                    await execute(conn, q.REVISION_DROP_PENDING, (story_id, rev, 0))
+                raise
+            # Still readable from edits. The next save makes a snapshot again
+            logger.exception(f'Snapshot {rev} of story {story_id} was not saved')
+        else:
+            async with get_conn() as conn:
+                if not await execute(conn, q.REVISION_MARK_SNAPSHOT, (story_id, rev)):
+                    raise Exception400(f'Story was changed since revision {latest_rev}')
+            await _prune(story_id)
+    _texts.put(f'{story_id}.{rev}', text.encode(), _texts.token())
+    return rev, text
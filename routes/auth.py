@@ -1,14 +1,12 @@
-from passlib.hash import pbkdf2_sha256 as sha256
 from fastapi import APIRouter
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
-from datetime import datetime
-from uuid import uuid4
 from loguru import logger
-import os
 from functools import wraps
 from globals import get_conn, sessions
+from queries import fetch_one, execute, USER_INSERT, USER_LOGIN, USER_SET_PASSWORD
 from utils import Exception400
+from hashing import hash_password, verify_password
 
 auth_router = APIRouter(prefix='/auth', tags=['Session management'])
 
@@ -16,13 +14,18 @@ def auth_required(func):
     @wraps(func)
     async def wrapper(*args, **kwargs):
         sid = kwargs['r'].sid
-        if sid not in sessions:
+        if await sessions.get(sid) is None:
             async def route_substitution(*args, **kwargs):
                 raise Exception400('Invalid session')
             return await route_substitution(*args, **kwargs)
         return await func(*args, **kwargs)
     return wrapper
 
+async def session_uid(sid: str | None) -> int | None:
+    """Id of the user who owns the session, None if session is invalid or expired"""
+    session = await sessions.get(sid)
+    return None if session is None else session.uid
+
 class AuthRequest(BaseModel):
     login: str = Field(description="Login must not contain spaces", pattern=r'^[ ]*')
     password: str
@@ -34,12 +37,9 @@ class LoginResponse(BaseModel):
 async def reg(r: AuthRequest):
     """Asks login and password (both are strings).
     Returns {result:OK} on success and code 500 on error"""
-    conn = get_conn()
-    with conn:
-        with conn.cursor() as cur:
-            cur.execute('INSERT INTO sf.users (name, password) VALUES (%s, %s)',
-                        (r.login, sha256.hash(r.password + os.environ.get('SALT', ''))))
-            conn.commit()
+    hashed = await hash_password(r.password)
+    async with get_conn() as conn:
+        await execute(conn, USER_INSERT, (r.login, hashed))
     return {'result': 'OK'}
 
 
@@ -47,17 +47,16 @@ async def reg(r: AuthRequest):
 async def login(r: AuthRequest) -> LoginResponse:
     """Asks login and password (both are strings).
     Returns {result:OK, 'sid': <session id>} on success and code 500 on error"""
-    conn = get_conn()
-    with conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT password, id FROM sf.users "
-                        f"WHERE name=\'{r.login}\'")
-            row = cur.fetchone()
-            if row is None or not sha256.verify(r.password + os.environ.get('SALT', ''), row[0]):
-                return JSONResponse({'result': 'Wrong login or password'}, 403)
-    sid = str(uuid4())
-    sessions[sid] = {'name': r.login, 'uid': row[1], 'started': datetime.now()}
-    return LoginResponse(sid=sid)
+    async with get_conn() as conn:
+        row = await fetch_one(conn, USER_LOGIN, (r.login,))
+    # Do not hold DB connection while hashing
+    correct, new_hash = await verify_password(r.password, row[0]) if row is not None else (False, None)
+    if not correct:
+        return JSONResponse({'result': 'Wrong login or password'}, 403)
+    if new_hash is not None:
+        async with get_conn() as conn:
+            await execute(conn, USER_SET_PASSWORD, (new_hash, row[1]))
+    return LoginResponse(sid=await sessions.create(row[1], r.login))
 
 
 class LogoutRequest(BaseModel):
@@ -67,5 +66,5 @@ class LogoutRequest(BaseModel):
 @auth_router.post('/logout')
 async def logout(r: LogoutRequest):
     """Removes session on success"""
-    sessions.pop(r.sid, 0)
+    await sessions.delete(r.sid)
     return {'result': 'OK'}
\ No newline at end of file
@@ -1,17 +1,34 @@
 import os
-from fastapi import APIRouter, UploadFile
-from fastapi.responses import Response
+import json
+import asyncio
+import random
+import base64
+import hashlib
+import mimetypes
+from fastapi import APIRouter, UploadFile, Query
+from fastapi.requests import Request
+from fastapi.responses import Response, StreamingResponse, FileResponse
 from pydantic import BaseModel, Field
-from routes.auth import auth_required
+from routes.auth import auth_required, session_uid
 from datetime import datetime
 from enum import Enum
-import dropbox
-from globals import get_conn, sessions
-from utils import Exception400
+from globals import get_conn
+import queries as q
+from queries import fetch_all, fetch_one, execute, story_owner, forget_story
+from utils import Exception400, cache_headers, not_modified, requested_range
+from cache import ByteCache
 import box_api
+import content_encoding
+import fast_json
+import votes
+import revisions
+import search
 from loguru import logger
 
 storage_router = APIRouter(prefix='/storage', tags=['Access to storage'])
+# Compressed story_content responses by story, revision and encoding. Filled on save and on first read of a revision
+_compressed = ByteCache(max_bytes=int(os.environ.get('COMPRESSED_CACHE_BYTES', str(32 * 2**20))),
+                        max_item_bytes=int(os.environ.get('CACHE_MAX_ITEM_BYTES', str(4 * 2**20))))
 
 class User(BaseModel):
     id: int
@@ -54,12 +71,28 @@ class IncreaseParamRequest(BaseModel):
 class IncreaseParamResponse(BaseModel):
     new_value: int
 
+_story_layout = fast_json.layout(Story)
+_review_layout = fast_json.layout(Review)
+
 class GetByIdRequest(BaseModel):
     id: int
     sid: str | None = Field(description="Session id returned by login or reg route",
                             default=None)
     detailed: bool = False
 
+class GetByIdsRequest(BaseModel):
+    ids: list[int] = Field(max_length=100, description='Missing ids and private stories of other users are skipped')
+    sid: str | None = Field(description="Session id returned by login or reg route",
+                            default=None)
+    detailed: bool = False
+
+
+class SearchStoriesRequest(BaseModel):
+    query: str = Field(min_length=1, max_length=1000, description='Words to find in names and content. '
+                                                                  'Supports "quoted phrases", -excluded words and or')
+    sid: str | None = Field(default=None, description='Required only to find own private stories')
+    offset: int = 0
+    limit: int = Field(default=15, ge=1, le=100)
 
 class StoriesListingTypeEnum(str, Enum):
     home = 'home'
@@ -71,9 +104,12 @@ class ListStoriesRequest(BaseModel):
     sid: str | None = Field(default=None, description='Required only to view private stories (e.g. "My projects" page)')
     offset: int = 0
     limit: int = 15
+    cursor: str | None = Field(default=None, description='next_cursor of the previous page. '
+                                                         'Pages by cursor are equally fast at any depth, unlike offset')
 
 class ListStoriesResponse(BaseModel):
     stories: list[Story]
+    next_cursor: str | None = Field(default=None, description='Pass it to get the next page. Null on the last page')
 
 class ListStoryAssetsRequests(BaseModel):
     story_id: int
@@ -86,10 +122,29 @@ class DeleteAssetRequest(BaseModel):
     story_id: int = Field(description="Story id")
     name: str = Field(description="Asset name")
 
+class DeleteAssetsRequest(BaseModel):
+    sid: str
+    story_id: int = Field(description="Story id")
+    names: list[str] = Field(max_length=1000, description="Asset names")
+
+class BulkAssetsResponse(BaseModel):
+    result: str = Field(default='OK')
+    errors: dict[str, str] = Field(default={}, description='Asset name -> reason, for assets that failed')
+
+class StoryContentRequest(GetByIdRequest):
+    rev: int | None = Field(default=None, ge=0, description='Revision to return. Latest by default')
+    since_rev: int | None = Field(default=None, ge=0, description='Revision the client already has. If possible, '
+                                                                   'only edits made since it are returned in ops')
+
 class UpdateStoryContentRequest(BaseModel):
     sid: str
     id: int
-    content: str
+    content: str | None = Field(default=None, description='Whole new content. Either content or ops is required')
+    ops: list[tuple[int, int, str]] | None = Field(default=None, description='Edits [position, number of deleted '
+                                                   'characters, inserted text] applied in order to base_rev. '
+                                                   'Positions are in Unicode code points')
+    base_rev: int | None = Field(default=None, description='Revision the changes were made to. Required with ops. '
+                                                           'Saving fails if the story was changed since then')
 
 class UpdateStoryProperties(BaseModel):
     sid: str
@@ -98,7 +153,9 @@ class UpdateStoryProperties(BaseModel):
     name: str | None = Field(default=None, description='Use ONLY if this property was changed by user')
 
 class ContentResponse(BaseModel):
-    content: str
+    content: str | None = Field(description='Null when ops are returned')
+    rev: int = 0
+    ops: list[tuple[int, int, str]] | None = Field(default=None, description='Edits turning since_rev into rev')
     result: str = Field(default='OK')
 
 class NewStoryRequest(BaseModel):
@@ -122,196 +179,353 @@ class DeletereviewRequest(BaseModel):
 
 @storage_router.put('/user_by_id')
 async def user_by_id(r: GetByIdRequest) -> User:
-    conn = get_conn()
-    with conn:
-        with conn.cursor() as cur:
-            cur.execute(f"SELECT name FROM sf.users WHERE id=\'{r.id}\'")
-            row = cur.fetchone()
-            name = row[0]
-            stories, reviews = None, None
-            if r.detailed:
-                cur.execute("SELECT id, author FROM sf.stories "
-                            f"WHERE author=\'{r.id}\'")
-                stories = [i[0] for i in cur.fetchall()]
-                cur.execute("SELECT id, author FROM sf.reviews "
-                            f"WHERE author=\'{r.id}\'")
-                reviews = [i[0] for i in cur.fetchall()]
-            return User(id=r.id, name=name, stories=stories, reviews=reviews)
-
+    async with get_conn() as conn:
+        row = await fetch_one(conn, q.USER_NAME, (r.id,))
+        if row is None:
+            raise Exception400('Invalid user id')
+        stories, reviews = None, None
+        if r.detailed:
+            stories = dict(await fetch_all(conn, q.STORY_IDS_BY_AUTHOR, ([r.id],))).get(r.id, [])
+            reviews = dict(await fetch_all(conn, q.REVIEW_IDS_BY_AUTHOR, ([r.id],))).get(r.id, [])
+    return User(id=r.id, name=row[0], stories=stories, reviews=reviews)
+
+
+async def _random_stories(count):
+    """Up to count distinct random public stories. Fewer only if there are not enough public stories"""
+    stories = {}
+    async with get_conn() as conn:
+        while len(stories) < count:
+            # Ask for more points than needed, because some of them may land on the same story
+            found = await fetch_all(conn, q.RANDOM_STORIES, ((count - len(stories)) * 2, list(stories), list(stories)),
+                                    Story)
+            if not found:
+                break
+            stories |= {story.id: story for story in found}
+    stories = list(stories.values())
+    random.shuffle(stories)
+    return stories[:count]
 
 @storage_router.get('/random_story')
 async def random_story() -> Story:
-    conn = get_conn()
-    with conn:
-        with conn.cursor() as cur:
-            cur.execute(f"SELECT * FROM sf.stories WHERE not private ORDER BY random() LIMIT 1")
-            row = cur.fetchone()
-            cols = {k.name: v for k, v in zip(cur.description, row)}
-            cur.execute(f"SELECT id, author FROM sf.reviews WHERE story=\'{cols['id']}\'")
-            reviews = [i[0] for i in cur.fetchall()]
-            return Story(**cols, reviews=reviews)
+    stories = await _random_stories(1)
+    if not stories:
+        raise Exception400('There are no public stories')
+    return stories[0]
+
+@storage_router.get('/random_stories')
+async def random_stories(count: int = Query(ge=1, le=50, description='Number of distinct stories')) -> list[Story]:
+    """Fewer stories are returned only if there are not that many public stories"""
+    stories = await _random_stories(count)
+    if not stories:
+        raise Exception400('There are no public stories')
+    return stories
 
 @storage_router.put('/story_by_id')
-async def story_by_id(r: GetByIdRequest) -> Story:
-    conn = get_conn()
-    with conn:
-        with conn.cursor() as cur:
-            cur.execute(f"SELECT * FROM sf.stories WHERE id=\'{r.id}\'")
-            row = cur.fetchone()
-            cols = {k.name: v for k, v in zip(cur.description, row)}
-            if cols['private'] and (r.sid is None or r.sid not in sessions or\
-                                    sessions[r.sid]['uid'] != cols['author']):
-                raise Exception400('Invalid session id')
-            reviews = None
-            if r.detailed:
-                cur.execute(f"SELECT id, author FROM sf.reviews WHERE story=\'{r.id}\'")
-                reviews = [i[0] for i in cur.fetchall()]
-            return Story(**cols, reviews=reviews)
+async def story_by_id(r: GetByIdRequest, request: Request, response: Response) -> Story:
+    """Supports conditional requests (If-None-Match) and returns 304 if story has not changed"""
+    async with get_conn() as conn:
+        story = await fetch_one(conn, q.STORY_BY_ID_DETAILED if r.detailed else q.STORY_BY_ID, (r.id,), Story)
+    if story is None:
+        raise Exception400('Invalid story id')
+    if story.private and await session_uid(r.sid) != story.author:
+        raise Exception400('Invalid session id')
+    # Votes and reviews do not change updated_at, so ETag is built from the whole response
+    # and Last-Modified/If-Modified-Since are not used
+    etag = hashlib.sha1(story.model_dump_json().encode()).hexdigest()
+    headers = cache_headers(etag, None, story.private)
+    if not_modified(request, etag, None):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return story
 
 @storage_router.put('/review_by_id')
 async def review_by_id(r: GetByIdRequest) -> Review:
-    conn = get_conn()
-    with conn:
-        with conn.cursor() as cur:
-            cur.execute(f"SELECT * FROM sf.reviews WHERE id=\'{r.id}\'")
-            row = cur.fetchone()
-            return Review(**{k.name: v for k, v in zip(cur.description, row)})
+    async with get_conn() as conn:
+        review = await fetch_one(conn, q.REVIEW_BY_ID, (r.id,), Review)
+    if review is None:
+        raise Exception400('Invalid review id')
+    return review
+
+async def _check_reader(story_id, sid):
+    """Raise if story is private and session does not belong to its author. Returns whether story is private"""
+    owner = await story_owner(story_id)
+    if owner is None:
+        raise Exception400('Invalid story id')
+    if owner[1] and await session_uid(sid) != owner[0]:
+        raise Exception400('Invalid session id')
+    return owner[1]
+
+async def _check_author(story_id, sid):
+    """Raise if session does not belong to author of the story"""
+    owner = await story_owner(story_id)
+    if owner is None or await session_uid(sid) != owner[0]:
+        raise Exception400('Invalid session id')
+
+@storage_router.put('/users_by_ids')
+async def users_by_ids(r: GetByIdsRequest) -> list[User]:
+    """Batch version of user_by_id. Users are returned in the order of requested ids"""
+    async with get_conn() as conn:
+        names = dict(await fetch_all(conn, q.USER_NAMES, (r.ids,)))
+        stories, reviews = {}, {}
+        if r.detailed:
+            stories = dict(await fetch_all(conn, q.STORY_IDS_BY_AUTHOR, (list(names),)))
+            reviews = dict(await fetch_all(conn, q.REVIEW_IDS_BY_AUTHOR, (list(names),)))
+    return [User(id=i, name=names[i],
+                 stories=stories.get(i, []) if r.detailed else None,
+                 reviews=reviews.get(i, []) if r.detailed else None)
+            for i in dict.fromkeys(r.ids) if i in names]
+
+@storage_router.put('/stories_by_ids')
+async def stories_by_ids(r: GetByIdsRequest) -> list[Story]:
+    """Batch version of story_by_id. Stories are returned in the order of requested ids"""
+    uid = await session_uid(r.sid)
+    async with get_conn() as conn:
+        rows = await fetch_all(conn, q.STORIES_BY_IDS_DETAILED if r.detailed else q.STORIES_BY_IDS, (r.ids, uid),
+                               dict if fast_json.enabled else Story)
+    if fast_json.enabled:
+        stories = {row['id']: row for row in fast_json.project(rows, _story_layout)}
+        return fast_json.response([stories[i] for i in dict.fromkeys(r.ids) if i in stories])
+    stories = {s.id: s for s in rows}
+    return [stories[i] for i in dict.fromkeys(r.ids) if i in stories]
+
+@storage_router.put('/reviews_by_ids')
+async def reviews_by_ids(r: GetByIdsRequest) -> list[Review]:
+    """Batch version of review_by_id. Reviews are returned in the order of requested ids"""
+    async with get_conn() as conn:
+        rows = await fetch_all(conn, q.REVIEWS_BY_IDS, (r.ids,), dict if fast_json.enabled else Review)
+    if fast_json.enabled:
+        reviews = {row['id']: row for row in fast_json.project(rows, _review_layout)}
+        return fast_json.response([reviews[i] for i in dict.fromkeys(r.ids) if i in reviews])
+    reviews = {v.id: v for v in rows}
+    return [reviews[i] for i in dict.fromkeys(r.ids) if i in reviews]
 
 @storage_router.post('/new_story')
 @auth_required
 async def new_story(r: NewStoryRequest) -> Story:
-    conn = get_conn()
-    with conn:
-        with conn.cursor() as cur:
-            cur.execute('INSERT INTO sf.stories (name, author) VALUES'
-                        f"('{r.name}',{sessions[r.sid]['uid']}) RETURNING *")
-            row = cur.fetchone()
-            conn.commit()
-            box_api.upload(r.content.encode('utf-8'), f'{os.environ['STORAGE_PREFIX']}/stories/{row[0]}.xml')
-            return Story(**{k.name: v for k, v in zip(cur.description, row)}, reviews=[])
+    uid = await session_uid(r.sid)
+    async with get_conn() as conn:
+        story = await fetch_one(conn, q.STORY_INSERT, (r.name, uid), Story)
+    story.reviews = []
+    await box_api.upload(r.content.encode('utf-8'), revisions.story_path(story.id, 0))
+    await search.index_content(story.id, r.content)
+    await _precompress(story.id, 0, r.content)
+    return story
 
 @storage_router.post('/new_review')
 @auth_required
 async def new_review(r: NewreviewRequest) -> Review:
-    conn = get_conn()
-    with conn:
-        with conn.cursor() as cur:
-            cur.execute('INSERT INTO sf.reviews (author, story, content) VALUES'
-                        f"({sessions[r.sid]['uid']}, {r.story}, '{r.content}') RETURNING *")
-            row = cur.fetchone()
-            conn.commit()
-        return Review(**{k.name: v for k, v in zip(cur.description, row)})
+    uid = await session_uid(r.sid)
+    async with get_conn() as conn:
+        return await fetch_one(conn, q.REVIEW_INSERT, (uid, r.story, r.content), Review)
 
 @storage_router.put('/story_content')
-async def story_content(r: GetByIdRequest):
-    conn = get_conn()
-    with conn:
-        with conn.cursor() as cur:
-            cur.execute(f"SELECT private, author, id FROM sf.stories WHERE id='{r.id}'")
-            row = cur.fetchone()
-            if row[0] and (r.sid is None or r.sid not in sessions or
-                           sessions[r.sid]['uid'] != row[1]):
-                raise Exception400('Invalid session id')
-            return ContentResponse(content=box_api.file_content(f'{os.environ['STORAGE_PREFIX']}/stories/{r.id}.xml'))
-
-_order_by = {
-    'best': 'votes, created_at, id',
-    'home': 'power((votes+1)*cast(extract(epoch from updated_at) as BigInt), 2), id',
-    'user': 'updated_at, id'
-}
+async def story_content(r: StoryContentRequest, request: Request, response: Response):
+    """Supports conditional requests (If-None-Match/If-Modified-Since) and returns 304 if content has not changed"""
+    private = await _check_reader(r.id, r.sid)
+    latest_rev, saved_at = await revisions.latest(r.id)
+    rev = latest_rev if r.rev is None else r.rev
+    if rev > latest_rev or r.since_rev is not None and r.since_rev > rev:
+        raise Exception400('Invalid revision')
+    if saved_at is None:
+        meta = await box_api.file_meta(revisions.story_path(r.id, 0))
+        etag, modified = meta.etag, meta.modified
+    else:
+        etag, modified = f'{r.id}.{rev}', saved_at  # revisions never change
+    if r.since_rev is not None:
+        etag += f'-{r.since_rev}'
+    headers = cache_headers(etag, modified, private=private)
+    if not_modified(request, etag, modified):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    if r.since_rev is not None and (ops := await revisions.delta(r.id, r.since_rev, rev)) is not None:
+        return ContentResponse(content=None, rev=rev, ops=ops)
+    encoding = content_encoding.negotiate(request.headers.get('accept-encoding'))
+    if encoding is None:
+        return ContentResponse(content=await revisions.content(r.id, rev), rev=rev)
+    if (body := _compressed.get(f'{r.id}.{rev}.{encoding}')) is None:
+        body = (await _precompress(r.id, rev, await revisions.content(r.id, rev), [encoding]))[encoding]
+    return content_encoding.response(body, encoding, 'application/json', headers)
+
+async def _precompress(story_id, rev, text, encodings=None) -> dict[str, bytes]:
+    """Compress the story_content response of the revision once and cache it. All supported encodings by default"""
+    body = ContentResponse(content=text, rev=rev).model_dump_json().encode()
+    encodings = content_encoding.ENCODINGS if encodings is None else encodings
+    # Compressing a big story takes milliseconds, keep it off the event loop
+    compressed = await asyncio.to_thread(lambda: {e: content_encoding.compress(body, e) for e in encodings})
+    for encoding, data in compressed.items():
+        _compressed.put(f'{story_id}.{rev}.{encoding}', data)
+    return compressed
+
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, default=datetime.isoformat).encode()).decode()
+
+def _cursor_value(key, value):
+    """Value of the cursor in the type of its column, so a forged cursor never reaches Postgres"""
+    if key.endswith('_at'):
+        if not isinstance(value, str):
+            raise ValueError(key)
+        return datetime.fromisoformat(value)
+    if isinstance(value, bool) or not isinstance(value, (int, float) if key == 'rank' else int) \
+            or key != 'rank' and not -2**31 <= value < 2**31:  # other keys are integer columns
+        raise ValueError(key)
+    return value
+
+def _decode_cursor(cursor, keys):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor))
+        if not isinstance(values, list) or len(values) != len(keys):
+            raise ValueError('Wrong number of values')
+        return [_cursor_value(k, v) for k, v in zip(keys, values)]
+    except Exception:
+        raise Exception400('Invalid cursor')
+
 @storage_router.put('/list_stories')
 async def list_stories(r: ListStoriesRequest) -> ListStoriesResponse:
-    """ATTENTION! This endpoint puts null/None into the reviews field.
-    If you want get a specific user's stories, provide his SID."""
-    conn = get_conn()
-    with conn:
-        with conn.cursor() as cur:
-            if r.listing_type.name == 'user' and (r.sid is None or r.sid not in sessions):
-                raise Exception400('Invalid session id')
-            cur.execute(f"SELECT * FROM sf.stories {f'WHERE author={sessions[r.sid]['uid']}'
-                                                    if r.listing_type.name == 'user' else ''}\n"
-                        f"ORDER BY {_order_by[r.listing_type.name]} DESC LIMIT {r.limit} OFFSET {r.offset}")
-            stories=[Story(**{ k.name: v for k, v in zip(cur.description, row)}) for row in cur.fetchall()]
-            return ListStoriesResponse(stories=stories)
+    """If you want get a specific user's stories, provide his SID."""
+    uid = await session_uid(r.sid) if r.listing_type.name == 'user' else None
+    if r.listing_type.name == 'user' and uid is None:
+        raise Exception400('Invalid session id')
+    keys = q.STORY_ORDER[r.listing_type.name]
+    params = [] if uid is None else [uid]
+    if r.cursor is not None:
+        params += _decode_cursor(r.cursor, keys)
+    async with get_conn() as conn:
+        # Rows as dicts, because rank is needed for the cursor but is not part of Story
+        rows = await fetch_all(conn, q.LIST_STORIES[r.listing_type.name, r.cursor is not None],
+                               params + [r.limit, r.offset], dict)
+    next_cursor = _encode_cursor([rows[-1][k] for k in keys]) if rows and len(rows) == r.limit else None
+    if fast_json.enabled:
+        return fast_json.response({'stories': fast_json.project(rows, _story_layout), 'next_cursor': next_cursor})
+    return ListStoriesResponse(stories=[Story(**cols) for cols in rows], next_cursor=next_cursor)
+
+@storage_router.put('/search_stories')
+async def search_stories(r: SearchStoriesRequest) -> list[Story]:
+    """Stories whose name or content match the query, best matches first. Matches in names rank higher"""
+    uid = await session_uid(r.sid)
+    async with get_conn() as conn:
+        rows = await fetch_all(conn, q.SEARCH_STORIES, (r.query, uid, r.limit, r.offset),
+                               dict if fast_json.enabled else Story)
+    if fast_json.enabled:
+        return fast_json.response(fast_json.project(rows, _story_layout))
+    return rows
 
 @storage_router.post('/update_story_content')
 async def update_story_content(r: UpdateStoryContentRequest):
-    conn = get_conn()
-    with conn:
-        with conn.cursor() as cur:
-            cur.execute(f"SELECT private, author, id FROM sf.stories WHERE id='{r.id}'")
-            row = cur.fetchone()
-            if r.sid is None or r.sid not in sessions or sessions[r.sid]['uid'] != row[1]:
-                raise Exception400('Invalid session id')
-    box_api.upload(r.content.encode(), f'{os.environ['STORAGE_PREFIX']}/stories/{r.id}.xml')
-    return {"result": "OK"}
+    """Send either whole content or ops made to base_rev. Returns number of the new revision"""
+    await _check_author(r.id, r.sid)
+    if (r.content is None) == (r.ops is None) or r.ops is not None and r.base_rev is None:
+        raise Exception400('Pass either content or ops with base_rev')
+    rev, text = await revisions.save(r.id, r.content, r.ops, r.base_rev)
+    await search.index_content(r.id, text)
+    await _precompress(r.id, rev, text)
+    return {"result": "OK", "rev": rev}
 
 @storage_router.post('/update_story_properties')
 async def update_story_properties(r: UpdateStoryProperties):
-    conn = get_conn()
-    with conn:
-        with conn.cursor() as cur:
-            cur.execute(f"SELECT author, id FROM sf.stories WHERE id=\'{r.id}\'")
-            row = cur.fetchone()
-            if r.sid is None or r.sid not in sessions or row[0] != sessions[r.sid]['uid']:
-                raise Exception400('Invalid session id')
-            if r.private is not None:
-                cur.execute(f"UPDATE sf.stories\n"
-                            f"SET private={r.private}\n"
-                            f"WHERE id={r.id}")
-            if r.name is not None:
-                cur.execute(f"UPDATE sf.stories\n"
-                            f"SET name='{r.name}'\n"
-                            f"WHERE id={r.id}")
-            conn.commit()
+    await _check_author(r.id, r.sid)
+    async with get_conn() as conn:
+        if r.private is not None:
+            await execute(conn, q.STORY_SET_PRIVATE, (r.private, r.id))
+        if r.name is not None:
+            await execute(conn, q.STORY_SET_NAME, (r.name, r.id))
+    forget_story(r.id)
     return {'result': 'OK'}
 
+async def _file_response(path, request):
+    """Send the file directly from disk when storage backend allows it, otherwise stream it chunk by chunk.
+    Returns 304 if client already has this version of the file"""
+    meta = await box_api.file_meta(path)
+    headers = cache_headers(meta.etag, meta.modified)
+    if not_modified(request, meta.etag, meta.modified):
+        return Response(status_code=304, headers=headers)
+    if (local := box_api.local_path(path)) is not None:
+        return FileResponse(local, headers=headers)  # handles Range by itself
+    size, chunks = await box_api.open_stream(path)
+    headers['Accept-Ranges'] = 'bytes'
+    if (part := requested_range(request, meta.etag, size)) is None:
+        return StreamingResponse(chunks, media_type=mimetypes.guess_type(path)[0],
+                                 headers=headers | {'Content-Length': str(size)})
+    if not part:
+        await chunks.aclose()
+        return Response(status_code=416, headers=headers | {'Content-Range': f'bytes */{size}'})
+    return StreamingResponse(box_api.byte_range(chunks, part.start, part.stop), 206,
+                             media_type=mimetypes.guess_type(path)[0],
+                             headers=headers | {'Content-Length': str(len(part)),
+                                                'Content-Range': f'bytes {part.start}-{part.stop - 1}/{size}'})
+
+def _asset_path(story_id, name):
+    """Path of the asset in the folder of the story. Names are single file names, so a request cannot reach
+    files of other stories or the folder itself"""
+    if not name or name in ('.', '..') or '/' in name or '\\' in name:
+        raise Exception400('Invalid asset name')
+    return f'{os.environ['STORAGE_PREFIX']}/assets/{story_id}/{name}'
+
 @storage_router.get('/asset_content/{story_id}/{name}')
-async def asset_content(story_id: int, name: str):
+async def asset_content(story_id: int, name: str, request: Request):
     try:
-        content = box_api.file_content(f'{os.environ['STORAGE_PREFIX']}/assets/{story_id}/{name}', decode=False)
-        return Response(content)
-    except dropbox.exceptions.ApiError as e:
+        return await _file_response(_asset_path(story_id, name), request)
+    except FileNotFoundError as e:
         logger.info(str(e))
-        return Response(box_api.file_content(f'{os.environ['STORAGE_PREFIX']}/assets/0/stub.png', decode=False))
-        
+        return await _file_response(f'{os.environ['STORAGE_PREFIX']}/assets/0/stub.png', request)
+
 
 @storage_router.post('/new_asset')
 async def new_asset(file: UploadFile, sid: str, story_id: int):
-    story = await story_by_id(GetByIdRequest(id=story_id))
-    if sid not in sessions or story.author != sessions[sid]['uid']:
-        raise Exception400('Invalid session id')
-    box_api.upload(await file.read(), f'{os.environ['STORAGE_PREFIX']}/assets/{story_id}/{file.filename}')
-    logger.info(f'Uploaded to {os.environ['STORAGE_PREFIX']}/assets/{story_id}/{file.filename}')
+    await _check_author(story_id, sid)
+    path = _asset_path(story_id, file.filename)
+    await box_api.upload_file(file.file, path, file.size or 0)
+    logger.info(f'Uploaded to {path}')
     return {'result': 'OK'}
 
 @storage_router.delete('/delete_asset')
 async def delete_asset(r: DeleteAssetRequest):
-    story = await story_by_id(GetByIdRequest(id=r.story_id))
-    if r.sid not in sessions or story.author != sessions[r.sid]['uid']:
-        raise Exception400('Invalid session id')
-    logger.info(f'Deleting {os.environ['STORAGE_PREFIX']}/assets/{r.story_id}/{r.name}')
-    box_api.delete(f'{os.environ['STORAGE_PREFIX']}/assets/{r.story_id}/{r.name}')
+    await _check_author(r.story_id, r.sid)
+    path = _asset_path(r.story_id, r.name)
+    logger.info(f'Deleting {path}')
+    await box_api.delete(path)
     return {'result': 'OK'}
 
+@storage_router.post('/new_assets')
+async def new_assets(files: list[UploadFile], sid: str, story_id: int) -> BulkAssetsResponse:
+    """Upload several assets at once. Assets that failed are listed in errors, others are saved"""
+    await _check_author(story_id, sid)
+    folder = f'{os.environ['STORAGE_PREFIX']}/assets/{story_id}'
+    errors, valid = {}, []
+    for f in files:
+        try:
+            valid.append((f, _asset_path(story_id, f.filename)))
+        except Exception400 as e:
+            errors[f.filename or ''] = str(e)
+    results = await box_api.upload_many([(f.file, path, f.size or 0) for f, path in valid]) if valid else []
+    errors |= {f.filename: e for (f, _), e in zip(valid, results) if e is not None}
+    logger.info(f'Uploaded {results.count(None)} of {len(files)} files to {folder}')
+    return BulkAssetsResponse(errors=errors)
+
+@storage_router.delete('/delete_assets')
+async def delete_assets(r: DeleteAssetsRequest) -> BulkAssetsResponse:
+    """Delete several assets at once. Assets that could not be deleted are listed in errors"""
+    await _check_author(r.story_id, r.sid)
+    folder = f'{os.environ['STORAGE_PREFIX']}/assets/{r.story_id}'
+    logger.info(f'Deleting {len(r.names)} files from {folder}')
+    errors, valid = {}, []
+    for name in r.names:
+        try:
+            valid.append((name, _asset_path(r.story_id, name)))
+        except Exception400 as e:
+            errors[name] = str(e)
+    results = await box_api.delete_many([path for _, path in valid]) if valid else []
+    errors |= {name: e for (name, _), e in zip(valid, results) if e is not None}
+    return BulkAssetsResponse(errors=errors)
+
 @storage_router.get('/list_story_assets/{story_id}')
 async def list_story_assets(story_id: int) -> ListStoryAssetsResponse:
-    return ListStoryAssetsResponse(assets=
-                                   [i.name for i in
-                                    box_api.list_files(f'{os.environ['STORAGE_PREFIX']}/assets/{story_id}/')])
+    return ListStoryAssetsResponse(assets=await box_api.list_files(f'{os.environ['STORAGE_PREFIX']}/assets/{story_id}/'))
 
 @storage_router.post('/increase_param')
 async def increase_param(r: IncreaseParamRequest) -> IncreaseParamResponse:
-    story = await story_by_id(GetByIdRequest(id=r.id))
-    if r.sid not in sessions or story.author != sessions[r.sid]['uid']:
-        raise Exception400('Invalid session id')
-    conn = get_conn()
-    with conn:
-        with conn.cursor() as cur:
-            cur.execute(f"UPDATE sf.{r.type.name}\n"
-                        f"SET {r.param.name}={r.param.name}+1*{r.up_or_down}\n"
-                        f"WHERE id={r.id}\n"
-                        f"RETURNING {r.param.name}")
-            row = cur.fetchone()
-            conn.commit()
-            return IncreaseParamResponse(new_value=row[0])
+    """Votes are written to DB in batches, so new_value is the expected value after pending votes are written"""
+    await _check_author(r.id, r.sid)
+    new_value = await votes.vote(r.type.name, r.id, r.up_or_down if r.up_or_down is not None else 1)
+    if new_value is None:
+        raise Exception400(f'Invalid {r.type.name} id')
+    return IncreaseParamResponse(new_value=new_value)
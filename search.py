@@ -0,0 +1,49 @@
+"""Full-text search over stories (see migrations/007_story_search.sql).
+Names are indexed by a trigger. Content lives in storage, so it is indexed here on every save.
+Run this module to index content of all existing stories: python search.py"""
+import os
+import re
+import html
+import asyncio
+from loguru import logger
+from globals import get_conn
+import queries as q
+from queries import execute, fetch_all
+
+SEARCH_MAX_CHARS = int(os.environ.get('SEARCH_MAX_CHARS', '200000'))  # longer content is indexed partially
+_tags = re.compile(r'<[^>]*>')
+
+
+def plain_text(xml: str) -> str:
+    """Text of story XML without tags, so tag and attribute names are not searchable"""
+    return html.unescape(_tags.sub(' ', xml))[:SEARCH_MAX_CHARS]
+
+async def index_content(story_id: int, xml: str):
+    async with get_conn() as conn:
+        await execute(conn, q.SEARCH_INDEX_CONTENT, (story_id, plain_text(xml)))
+
+
+async def _reindex_all():
+    import box_api
+    import revisions
+    from globals import open_pool, close_pool
+    if not box_api.authorized():
+        box_api.login('')
+    await open_pool()
+    try:
+        async with get_conn() as conn:
+            ids = [row[0] for row in await fetch_all(conn, q.ALL_STORY_IDS)]
+        for i, story_id in enumerate(ids, 1):
+            try:
+                rev, _ = await revisions.latest(story_id)
+                await index_content(story_id, await revisions.content(story_id, rev))
+            except FileNotFoundError:
+                logger.warning(f'Story {story_id} has no content')
+            if i % 1000 == 0:
+                logger.info(f'Indexed {i} of {len(ids)} stories')
+    finally:
+        await close_pool()
+
+
+if __name__ == '__main__':
+    asyncio.run(_reindex_all())
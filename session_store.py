@@ -0,0 +1,122 @@
+"""Session storage with sliding expiration. MemorySessionStore lives in one process,
+PostgresSessionStore keeps sessions in sf.sessions table and is shared by all workers and nodes"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+from time import time
+from uuid import uuid4
+from loguru import logger
+from psycopg_pool import AsyncConnectionPool
+
+
+class Session:
+    __slots__ = ('uid', 'name', 'started', 'expires')
+
+    def __init__(self, uid: int, name: str, started: datetime, expires: float):
+        self.uid = uid
+        self.name = name
+        self.started = started
+        self.expires = expires  # unix time
+
+
+class SessionStore:
+    """Session lives `ttl` seconds since last use"""
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+
+    async def create(self, uid: int, name: str) -> str:
+        """Start new session. Returns session id"""
+        raise NotImplementedError
+
+    async def get(self, sid: str | None) -> Session | None:
+        """Session if it exists and has not expired. Prolongs it"""
+        raise NotImplementedError
+
+    async def delete(self, sid: str):
+        raise NotImplementedError
+
+    async def purge(self) -> int:
+        """Remove expired sessions. Returns number of removed sessions"""
+        raise NotImplementedError
+
+    async def purge_forever(self, interval: float):
+        """Background task. Purges expired sessions every `interval` seconds"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if removed := await self.purge():
+                    logger.info(f'Purged {removed} expired sessions')
+            except Exception:
+                logger.exception('Failed to purge sessions')
+
+
+class MemorySessionStore(SessionStore):
+    def __init__(self, ttl):
+        super().__init__(ttl)
+        self._sessions: dict[str, Session] = {}
+
+    async def create(self, uid, name):
+        sid = str(uuid4())
+        self._sessions[sid] = Session(uid, name, datetime.now(timezone.utc), time() + self.ttl)
+        return sid
+
+    async def get(self, sid):
+        session = self._sessions.get(sid)
+        if session is None:
+            return None
+        now = time()
+        if session.expires < now:
+            del self._sessions[sid]
+            return None
+        session.expires = now + self.ttl
+        return session
+
+    async def delete(self, sid):
+        self._sessions.pop(sid, None)
+
+    async def purge(self):
+        now = time()
+        expired = [sid for sid, s in self._sessions.items() if s.expires < now]
+        for sid in expired:
+            del self._sessions[sid]
+        return len(expired)
+
+
+class PostgresSessionStore(SessionStore):
+    """Requires sf.sessions table (see migrations/001_sessions.sql).
+    Expiry is prolonged only when less than half of ttl is left, so most lookups do not write"""
+    def __init__(self, ttl, pool: AsyncConnectionPool):
+        super().__init__(ttl)
+        self.pool = pool
+
+    async def create(self, uid, name):
+        sid = str(uuid4())
+        async with self.pool.connection() as conn:
+            await conn.execute('INSERT INTO sf.sessions (sid, uid, name, expires) '
+                               'VALUES (%s, %s, %s, now() + %s)',
+                               (sid, uid, name, timedelta(seconds=self.ttl)), prepare=True)
+        return sid
+
+    async def get(self, sid):
+        if sid is None:
+            return None
+        async with self.pool.connection() as conn:
+            cur = await conn.execute('SELECT uid, name, started, extract(epoch from expires) FROM sf.sessions '
+                                     'WHERE sid=%s AND expires > now()', (sid,), prepare=True)
+            row = await cur.fetchone()
+            if row is None:
+                return None
+            session = Session(row[0], row[1], row[2], float(row[3]))
+            if session.expires - time() < self.ttl / 2:
+                session.expires = time() + self.ttl
+                await conn.execute('UPDATE sf.sessions SET expires=now() + %s WHERE sid=%s',
+                                   (timedelta(seconds=self.ttl), sid), prepare=True)
+        return session
+
+    async def delete(self, sid):
+        async with self.pool.connection() as conn:
+            await conn.execute('DELETE FROM sf.sessions WHERE sid=%s', (sid,))
+
+    async def purge(self):
+        async with self.pool.connection() as conn:
+            cur = await conn.execute('DELETE FROM sf.sessions WHERE expires <= now()')
+            return cur.rowcount
@@ -0,0 +1,367 @@
+"""Places where story XML and assets can live. Backends are synchronous, box_api runs them in its thread pool.
+Paths are always absolute Dropbox-like paths, e.g. /prefix/stories/1.xml. Missing files raise FileNotFoundError"""
+import os
+import shutil
+import time
+from io import BytesIO
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from datetime import datetime, timezone
+from typing import BinaryIO, Iterator, NamedTuple
+import dropbox
+from dropbox.stone_base import Union
+from utils import Exception400
+
+CHUNK_SIZE = 4 * 2**20  # Dropbox requires upload session chunks to be multiple of 4 MiB
+BATCH_SIZE = 1000  # max entries of one Dropbox batch call
+
+
+def _error(e: Exception) -> str:
+    """Reason shown to the client when one file of a batch fails. Does not reveal local paths"""
+    return 'Not found' if isinstance(e, FileNotFoundError) else str(e) or type(e).__name__
+
+# Dropbox error tags -> the reason other backends give for the same failure
+_DROPBOX_REASONS = {
+    'not_found': 'Not found',
+    'malformed_path': 'Invalid path',
+    'disallowed_name': 'Invalid path',
+    'conflict': 'Already exists',
+    'insufficient_space': 'No space left on storage',
+    'no_write_permission': 'Permission denied',
+    'access_restricted': 'Permission denied',
+    'too_many_write_operations': 'Too many writes, retry later',
+}
+
+def _dropbox_error(failure) -> str:
+    """Reason shown to the client for a failed entry of a Dropbox batch, instead of the SDK repr"""
+    tags = []
+    while isinstance(failure, Union):
+        tags.append(failure._tag)
+        failure = failure._value
+    return next((_DROPBOX_REASONS[t] for t in reversed(tags) if t in _DROPBOX_REASONS), 'Storage error')
+
+
+class FileMeta(NamedTuple):
+    etag: str  # changes whenever content changes
+    modified: datetime  # UTC
+
+
+class StorageBackend:
+    def ready(self) -> bool:
+        """Whether the backend can serve requests"""
+        return True
+
+    def read(self, path: str) -> bytes:
+        raise NotImplementedError
+
+    def stat(self, path: str) -> FileMeta:
+        raise NotImplementedError
+
+    def open(self, path: str) -> tuple[int, Iterator[bytes]]:
+        """Size of the file and iterator over its chunks, so big files are never fully in memory"""
+        data = self.read(path)
+        return len(data), iter((data,))
+
+    def write(self, data: bytes, path: str):
+        """Create or overwrite file"""
+        raise NotImplementedError
+
+    def write_stream(self, file: BinaryIO, path: str):
+        """Create or overwrite file reading data from file object chunk by chunk"""
+        self.write(file.read(), path)
+
+    def stage(self, file: BinaryIO):
+        """Upload content of file object without making it visible yet. The result is passed to commit_many"""
+        return file
+
+    def commit_many(self, staged: list[tuple[object, str]]) -> list[str | None]:
+        """Put staged files to their paths, overwriting existing ones. Returns error or None for every file"""
+        errors = []
+        for file, path in staged:
+            try:
+                self.write_stream(file, path)
+                errors.append(None)
+            except Exception as e:
+                errors.append(_error(e))
+        return errors
+
+    def delete(self, path: str):
+        """Remove file or folder with all its content"""
+        raise NotImplementedError
+
+    def delete_many(self, paths: list[str]) -> list[str | None]:
+        """Remove files or folders. Returns error or None for every path"""
+        errors = []
+        for path in paths:
+            try:
+                self.delete(path)
+                errors.append(None)
+            except Exception as e:
+                errors.append(_error(e))
+        return errors
+
+    def list(self, path: str) -> list[str]:
+        """Names of all entries in the folder"""
+        raise NotImplementedError
+
+    def copy(self, frm: str, to: str):
+        raise NotImplementedError
+
+    def mkdir(self, path: str):
+        raise NotImplementedError
+
+    def local_path(self, path: str) -> Path | None:
+        """Path in the local file system if the file can be sent directly from disk, otherwise None"""
+        return None
+
+
+@contextmanager
+def _dropbox_not_found(path):
+    """Dropbox reports missing files as ApiError. Turn them into FileNotFoundError like other backends do"""
+    try:
+        yield
+    except dropbox.exceptions.ApiError as e:
+        lookup = None
+        if hasattr(e.error, 'is_path') and e.error.is_path():
+            lookup = e.error.get_path()
+        elif hasattr(e.error, 'is_path_lookup') and e.error.is_path_lookup():
+            lookup = e.error.get_path_lookup()
+        if lookup is not None and lookup.is_not_found():
+            raise FileNotFoundError(f'{path} not found') from e
+        raise
+
+
+class DropboxBackend(StorageBackend):
+    def __init__(self):
+        self.dbx: dropbox.Dropbox | None = None  # set by box_api.login
+
+    def ready(self):
+        return bool(self.dbx)
+
+    def read(self, path):
+        with _dropbox_not_found(path):
+            return self.dbx.files_download(path)[1].content
+
+    def stat(self, path):
+        with _dropbox_not_found(path):
+            metadata = self.dbx.files_get_metadata(path)
+        return FileMeta(metadata.content_hash, metadata.server_modified.replace(tzinfo=timezone.utc))
+
+    def open(self, path):
+        with _dropbox_not_found(path):
+            metadata, response = self.dbx.files_download(path)
+
+        def chunks():
+            with response:
+                yield from response.iter_content(CHUNK_SIZE)
+        return metadata.size, chunks()
+
+    def write(self, data, path):
+        self.dbx.files_upload(data, path, dropbox.files.WriteMode.overwrite)
+
+    def write_stream(self, file, path):
+        chunk = file.read(CHUNK_SIZE)
+        next_chunk = file.read(CHUNK_SIZE)
+        if not next_chunk:
+            return self.write(chunk, path)
+        session = self.dbx.files_upload_session_start(chunk)
+        cursor = dropbox.files.UploadSessionCursor(session.session_id, offset=len(chunk))
+        while True:
+            chunk, next_chunk = next_chunk, file.read(CHUNK_SIZE)
+            if not next_chunk:
+                break
+            self.dbx.files_upload_session_append_v2(chunk, cursor)
+            cursor.offset += len(chunk)
+        self.dbx.files_upload_session_finish(chunk, cursor,
+                                             dropbox.files.CommitInfo(path, dropbox.files.WriteMode.overwrite))
+
+    def stage(self, file):
+        """Upload into a closed upload session, see files_upload_session_finish_batch_v2"""
+        chunk = file.read(CHUNK_SIZE)
+        next_chunk = file.read(CHUNK_SIZE)
+        session = self.dbx.files_upload_session_start(chunk, close=not next_chunk)
+        cursor = dropbox.files.UploadSessionCursor(session.session_id, offset=len(chunk))
+        while next_chunk:
+            chunk, next_chunk = next_chunk, file.read(CHUNK_SIZE)
+            self.dbx.files_upload_session_append_v2(chunk, cursor, close=not next_chunk)
+            cursor.offset += len(chunk)
+        return cursor
+
+    def commit_many(self, staged):
+        errors = []
+        for i in range(0, len(staged), BATCH_SIZE):
+            entries = [dropbox.files.UploadSessionFinishArg(cursor, dropbox.files.CommitInfo(
+                           path, dropbox.files.WriteMode.overwrite))
+                       for cursor, path in staged[i:i + BATCH_SIZE]]
+            result = self.dbx.files_upload_session_finish_batch_v2(entries)
+            errors += [None if e.is_success() else _dropbox_error(e.get_failure()) for e in result.entries]
+        return errors
+
+    def list(self, path):
+        with _dropbox_not_found(path):
+            result = self.dbx.files_list_folder(path)
+            names = [i.name for i in result.entries]
+            while result.has_more:
+                result = self.dbx.files_list_folder_continue(result.cursor)
+                names += [i.name for i in result.entries]
+        return names
+
+    def delete(self, path):
+        with _dropbox_not_found(path):
+            self.dbx.files_delete_v2(path)
+
+    def delete_many(self, paths):
+        errors = []
+        for i in range(0, len(paths), BATCH_SIZE):
+            launch = self.dbx.files_delete_batch([dropbox.files.DeleteArg(p) for p in paths[i:i + BATCH_SIZE]])
+            if launch.is_complete():
+                result = launch.get_complete()
+            else:
+                job_id = launch.get_async_job_id()
+                while (status := self.dbx.files_delete_batch_check(job_id)).is_in_progress():
+                    time.sleep(0.5)
+                if not status.is_complete():
+                    raise RuntimeError(f'Batch delete failed: {status}')
+                result = status.get_complete()
+            errors += [None if e.is_success() else _dropbox_error(e.get_failure()) for e in result.entries]
+        return errors
+
+    def copy(self, frm, to):
+        with _dropbox_not_found(frm):
+            self.dbx.files_copy_v2(from_path=frm, to_path=to)
+
+    def mkdir(self, path):
+        self.dbx.files_create_folder_v2(path)
+
+
+class LocalBackend(StorageBackend):
+    """Keeps files under `root` directory (local disk, NFS mount etc.).
+    Assets are sent with FileResponse, so the server can use sendfile instead of copying them through Python"""
+    def __init__(self, root: str):
+        self.root = Path(root).resolve()
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _resolve(self, path: str) -> Path:
+        full = (self.root / path.lstrip('/')).resolve()
+        if full != self.root and self.root not in full.parents:
+            raise Exception400('Invalid path')
+        return full
+
+    def read(self, path):
+        return self._resolve(path).read_bytes()
+
+    def stat(self, path):
+        st = self._resolve(path).stat()
+        return FileMeta(f'{st.st_mtime_ns:x}-{st.st_size:x}', datetime.fromtimestamp(st.st_mtime, timezone.utc))
+
+    def open(self, path):
+        full = self._resolve(path)
+        size = full.stat().st_size
+
+        def chunks():
+            with open(full, 'rb') as f:
+                while chunk := f.read(CHUNK_SIZE):
+                    yield chunk
+        return size, chunks()
+
+    def write(self, data, path):
+        self.write_stream(BytesIO(data), path)
+
+    def write_stream(self, file, path):
+        full = self._resolve(path)
+        full.parent.mkdir(parents=True, exist_ok=True)
+        # Write to temporary file first, so readers never see a half-written file
+        with NamedTemporaryFile(dir=full.parent, delete=False) as f:
+            shutil.copyfileobj(file, f, CHUNK_SIZE)
+        os.replace(f.name, full)
+
+    def stage(self, file):
+        # Temporary file inside root, so commit is an atomic rename on the same file system
+        with NamedTemporaryFile(dir=self.root, prefix='.upload-', delete=False) as f:
+            shutil.copyfileobj(file, f, CHUNK_SIZE)
+        return Path(f.name)
+
+    def commit_many(self, staged):
+        errors = []
+        for tmp, path in staged:
+            try:
+                full = self._resolve(path)
+                full.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(tmp, full)
+                errors.append(None)
+            except Exception as e:
+                tmp.unlink(missing_ok=True)
+                errors.append(_error(e))
+        return errors
+
+    def list(self, path):
+        return [i.name for i in self._resolve(path).iterdir() if not i.name.startswith('.upload-')]
+
+    def delete(self, path):
+        full = self._resolve(path)
+        if full.is_dir():
+            shutil.rmtree(full)
+        else:
+            full.unlink()
+
+    def copy(self, frm, to):
+        src, dst = self._resolve(frm), self._resolve(to)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        if src.is_dir():
+            shutil.copytree(src, dst)
+        else:
+            shutil.copy2(src, dst)
+
+    def mkdir(self, path):
+        self._resolve(path).mkdir(parents=True, exist_ok=True)
+
+    def local_path(self, path):
+        return self._resolve(path)
+
+
+class MemoryBackend(StorageBackend):
+    """Keeps files in a dict of this process. For benchmarks and local experiments, everything is lost on exit"""
+    def __init__(self):
+        self.files: dict[str, tuple[bytes, datetime]] = {}
+
+    def _get(self, path):
+        try:
+            return self.files[path]
+        except KeyError:
+            raise FileNotFoundError(f'{path} not found') from None
+
+    def read(self, path):
+        return self._get(path)[0]
+
+    def stat(self, path):
+        data, modified = self._get(path)
+        return FileMeta(f'{hash(data) & 0xffffffffffff:x}-{len(data):x}', modified)
+
+    def write(self, data, path):
+        self.files[path] = bytes(data), datetime.now(timezone.utc)
+
+    def list(self, path):
+        prefix = path.rstrip('/') + '/'
+        names = {p[len(prefix):].split('/')[0] for p in self.files if p.startswith(prefix)}
+        if not names:
+            raise FileNotFoundError(f'{path} not found')
+        return sorted(names)
+
+    def delete(self, path):
+        prefix = path.rstrip('/') + '/'
+        removed = [p for p in self.files if p == path or p.startswith(prefix)]
+        if not removed:
+            raise FileNotFoundError(f'{path} not found')
+        for p in removed:
+            del self.files[p]
+
+    def copy(self, frm, to):
+        prefix = frm.rstrip('/') + '/'
+        copied = {to + p[len(frm):]: v for p, v in self.files.items() if p == frm or p.startswith(prefix)}
+        if not copied:
+            raise FileNotFoundError(f'{frm} not found')
+        self.files.update(copied)
+
+    def mkdir(self, path):
+        pass  # folders exist as long as they have files
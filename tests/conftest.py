@@ -0,0 +1,9 @@
+"""Tests run without network: storage is kept in memory and the DB pool is never opened"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DB_PATH', 'postgresql://localhost/storyforge_test')
+os.environ.setdefault('STORAGE_PREFIX', '/test')
+os.environ['STORAGE_BACKEND'] = 'memory'
+os.environ['CACHE_DIR'] = ''  # set before .env is loaded, so the disk tier stays off
@@ -0,0 +1,104 @@
+import asyncio
+from io import BytesIO
+import pytest
+import box_api
+from cache import ByteCache
+from storage_backends import MemoryBackend
+
+FOLDER = '/test/assets/1'
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """Fresh memory backend and caches. Returns the list of backend reads and listings made"""
+    backend, calls = MemoryBackend(), []
+    for name in ('read', 'open', 'list'):
+        method = getattr(backend, name)
+        monkeypatch.setattr(backend, name, lambda path, name=name, method=method: calls.append((name, path))
+                            or method(path))
+    monkeypatch.setattr(box_api, 'backend', backend)
+    monkeypatch.setattr(box_api, 'cache', ByteCache(max_bytes=2**20, max_item_bytes=2**16))
+    monkeypatch.setattr(box_api, '_meta', type(box_api._meta)())
+    monkeypatch.setattr(box_api, '_listings', type(box_api._listings)())
+    return calls
+
+async def _read_stream(stream):
+    return b''.join([chunk async for chunk in stream])
+
+async def _chunks(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def test_file_content_is_read_once(calls):
+    async def run():
+        await box_api.upload(b'<story/>', f'{FOLDER}/a.xml')
+        assert await box_api.file_content(f'{FOLDER}/a.xml') == '<story/>'
+        assert await box_api.file_content(f'{FOLDER}/a.xml', decode=False) == b'<story/>'
+    asyncio.run(run())
+    assert calls == [('read', f'{FOLDER}/a.xml')]
+
+def test_upload_invalidates_cached_content(calls):
+    async def run():
+        await box_api.upload(b'old', f'{FOLDER}/a.xml')
+        assert await box_api.file_content(f'{FOLDER}/a.xml') == 'old'
+        await box_api.upload(b'new', f'{FOLDER}/a.xml')
+        return await box_api.file_content(f'{FOLDER}/a.xml')
+    assert asyncio.run(run()) == 'new'
+
+def test_delete_invalidates_cached_content(calls):
+    async def run():
+        await box_api.upload(b'data', f'{FOLDER}/a.png')
+        await box_api.file_content(f'{FOLDER}/a.png')
+        await box_api.delete(f'{FOLDER}/a.png')
+        with pytest.raises(FileNotFoundError):
+            await box_api.file_content(f'{FOLDER}/a.png')
+    asyncio.run(run())
+
+def test_listing_is_cached_until_folder_changes(calls):
+    async def run():
+        await box_api.upload(b'1', f'{FOLDER}/a.png')
+        assert await box_api.list_files(FOLDER) == ['a.png']
+        assert await box_api.list_files(FOLDER) == ['a.png']
+        assert calls.count(('list', FOLDER)) == 1
+        await box_api.upload_many([(BytesIO(b'2'), f'{FOLDER}/b.png', 1)])
+        assert sorted(await box_api.list_files(FOLDER)) == ['a.png', 'b.png']
+        await box_api.delete_many([f'{FOLDER}/a.png'])
+        assert await box_api.list_files(FOLDER) == ['b.png']
+    asyncio.run(run())
+
+def test_open_stream_caches_fully_sent_files(calls):
+    data = bytes(range(256)) * 10
+
+    async def run():
+        await box_api.upload(data, f'{FOLDER}/a.png')
+        size, stream = await box_api.open_stream(f'{FOLDER}/a.png')
+        assert size == len(data) and await _read_stream(stream) == data
+        assert ('open', f'{FOLDER}/a.png') in calls
+        calls.clear()
+        size, stream = await box_api.open_stream(f'{FOLDER}/a.png')
+        assert size == len(data) and await _read_stream(stream) == data
+    asyncio.run(run())
+    assert calls == []
+
+def test_open_stream_of_missing_file_raises_right_away(calls):
+    with pytest.raises(FileNotFoundError):
+        asyncio.run(box_api.open_stream(f'{FOLDER}/missing.png'))
+
+def test_partially_read_stream_is_not_cached(calls):
+    async def run():
+        await box_api.upload(b'0123456789', f'{FOLDER}/a.png')
+        _, stream = await box_api.open_stream(f'{FOLDER}/a.png')
+        assert await _read_stream(box_api.byte_range(stream, 0, 4)) == b'0123'
+    asyncio.run(run())
+    assert box_api.cache.get(f'{FOLDER}/a.png') is None
+
+@pytest.mark.parametrize('start, stop, expected', [
+    (0, 9, b'abcdefghi'),
+    (2, 7, b'cdefg'),
+    (3, 6, b'def'),
+    (8, 9, b'i'),
+])
+def test_byte_range_across_chunks(start, stop, expected):
+    stream = box_api.byte_range(_chunks(b'abc', b'def', b'ghi'), start, stop)
+    assert asyncio.run(_read_stream(stream)) == expected
@@ -0,0 +1,24 @@
+import pytest
+from revisions import apply
+from utils import Exception400
+
+
+@pytest.mark.parametrize('ops, expected', [
+    ([], 'hello world'),
+    ([(0, 0, '> ')], '> hello world'),
+    ([(5, 6, '')], 'hello'),
+    ([(6, 5, 'there')], 'hello there'),
+    ([(11, 0, '!')], 'hello world!'),
+    # Positions refer to the text after previous edits
+    ([(0, 5, 'hi'), (2, 0, ',')], 'hi, world'),
+])
+def test_apply(ops, expected):
+    assert apply('hello world', ops) == expected
+
+def test_apply_counts_characters_not_bytes():
+    assert apply('привет мир', [(7, 3, 'всем')]) == 'привет всем'
+
+@pytest.mark.parametrize('ops', [[(12, 0, 'x')], [(-1, 0, 'x')], [(5, 7, '')], [(0, -1, '')]])
+def test_apply_rejects_edits_out_of_bounds(ops):
+    with pytest.raises(Exception400):
+        apply('hello world', ops)
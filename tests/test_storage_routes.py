@@ -0,0 +1,36 @@
+import base64
+import json
+from datetime import datetime, timezone
+import pytest
+from routes.storage import _decode_cursor, _encode_cursor
+from utils import Exception400
+
+
+def cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+@pytest.mark.parametrize('keys, values', [
+    (('rank', 'id'), [12.5, 3]),
+    (('rank', 'id'), [12, 3]),
+    (('votes', 'created_at', 'id'), [5, datetime(2026, 1, 2, tzinfo=timezone.utc), 7]),
+    (('updated_at', 'id'), [datetime(2026, 1, 2, 3, 4, 5, 6, tzinfo=timezone.utc), 1]),
+])
+def test_cursor_round_trip(keys, values):
+    assert _decode_cursor(_encode_cursor(values), keys) == values
+
+@pytest.mark.parametrize('keys, value', [
+    (('rank', 'id'), cursor(['abc', 1])),
+    (('rank', 'id'), cursor([1, 'x'])),
+    (('rank', 'id'), cursor([True, 1])),
+    (('rank', 'id'), cursor([1, 1.5])),
+    (('rank', 'id'), cursor([1, 2**40])),
+    (('rank', 'id'), cursor([1])),
+    (('rank', 'id'), cursor({'rank': 1, 'id': 1})),
+    (('votes', 'created_at', 'id'), cursor([1, 'not a date', 1])),
+    (('votes', 'created_at', 'id'), cursor([1, 5, 1])),
+    (('rank', 'id'), 'not base64!'),
+])
+def test_invalid_cursor(keys, value):
+    with pytest.raises(Exception400):
+        _decode_cursor(value, keys)
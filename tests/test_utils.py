@@ -0,0 +1,55 @@
+from datetime import datetime, timezone
+import pytest
+from starlette.requests import Request
+from utils import requested_range, not_modified
+
+MODIFIED = datetime(2026, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+
+
+def request(**headers):
+    return Request({'type': 'http', 'headers': [(k.replace('_', '-').encode(), v.encode()) for k, v in headers.items()]})
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-9', range(0, 10)),
+    ('bytes=90-', range(90, 100)),
+    ('bytes=-5', range(95, 100)),
+    ('bytes=-500', range(0, 100)),
+    ('bytes=50-500', range(50, 100)),
+    ('bytes=100-', range(0)),  # not satisfiable
+    ('bytes=0-1,5-6', None),  # several ranges: whole file
+    ('bytes=5-2', None),
+    ('bytes=a-b', None),
+    ('items=0-9', None),
+    ('bytes=-', None),
+])
+def test_requested_range(header, expected):
+    assert requested_range(request(range=header), 'etag', 100) == expected
+
+def test_requested_range_without_header():
+    assert requested_range(request(), 'etag', 100) is None
+
+def test_requested_range_of_other_version():
+    assert requested_range(request(range='bytes=0-9', if_range='"old"'), 'etag', 100) is None
+    assert requested_range(request(range='bytes=0-9', if_range='"etag"'), 'etag', 100) == range(0, 10)
+
+
+@pytest.mark.parametrize('headers, expected', [
+    ({}, False),
+    ({'if_none_match': '"etag"'}, True),
+    ({'if_none_match': 'W/"etag"'}, True),
+    ({'if_none_match': '"other", "etag"'}, True),
+    ({'if_none_match': '*'}, True),
+    ({'if_none_match': '"other"'}, False),
+    ({'if_modified_since': 'Fri, 02 Jan 2026 03:04:05 GMT'}, True),
+    ({'if_modified_since': 'Fri, 02 Jan 2026 03:04:04 GMT'}, False),
+    ({'if_modified_since': 'yesterday'}, False),
+    # If-None-Match takes precedence
+    ({'if_none_match': '"other"', 'if_modified_since': 'Fri, 02 Jan 2026 03:04:05 GMT'}, False),
+])
+def test_not_modified(headers, expected):
+    assert not_modified(request(**headers), 'etag', MODIFIED) is expected
+
+def test_not_modified_without_modification_time_uses_etag_only():
+    assert not not_modified(request(if_modified_since='Fri, 02 Jan 2099 03:04:05 GMT'), 'etag', None)
+    assert not_modified(request(if_none_match='"etag"'), 'etag', None)
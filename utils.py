@@ -1,3 +1,57 @@
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi.requests import Request
+
+
 class Exception400(Exception):
     """Exception to return code 400 in response"""
-    pass
\ No newline at end of file
+    pass
+
+class Exception503(Exception):
+    """Exception to return code 503 in response. Server is overloaded, client should retry later"""
+    pass
+
+
+def _utc(dt: datetime) -> datetime:
+    return (dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt.astimezone(timezone.utc)).replace(microsecond=0)
+
+def cache_headers(etag: str, last_modified: datetime | None, private=False) -> dict:
+    """Headers for responses that clients may cache but must revalidate before reuse.
+    Pass None as last_modified when the modification time does not cover every change, so only ETag is used"""
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': f'{'private' if private else 'public'}, no-cache'}
+    if last_modified is not None:
+        headers['Last-Modified'] = format_datetime(_utc(last_modified), usegmt=True)
+    return headers
+
+def not_modified(request: Request | None, etag: str, last_modified: datetime | None) -> bool:
+    """Whether the client already has this version (conditional request).
+    If-None-Match takes precedence over If-Modified-Since"""
+    if request is None:
+        return False
+    if (tags := request.headers.get('if-none-match')) is not None:
+        return tags.strip() == '*' or f'"{etag}"' in [t.strip().removeprefix('W/') for t in tags.split(',')]
+    if last_modified is not None and (since := request.headers.get('if-modified-since')) is not None:
+        try:
+            return _utc(last_modified) <= parsedate_to_datetime(since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def requested_range(request: Request, etag: str, size: int) -> range | None:
+    """Bytes of a single-range request (Range header) of a file with this ETag and size.
+    None means the whole file should be sent: no Range, several ranges, invalid syntax or If-Range of another version.
+    An empty range means the range is not satisfiable (416)"""
+    header = request.headers.get('range')
+    if header is None or not header.startswith('bytes=') or ',' in header:
+        return None
+    if (if_range := request.headers.get('if-range')) is not None and if_range.strip() != f'"{etag}"':
+        return None
+    first, sep, last = header[len('bytes='):].strip().partition('-')
+    if not sep or first and not first.isdigit() or last and not last.isdigit() or not first and not last:
+        return None
+    if not first:  # last N bytes
+        return range(max(size - int(last), 0), size)
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    return range(start, min(int(last) + 1, size) if last else size) if start < size else range(0)
@@ -0,0 +1,137 @@
+"""Write-behind vote counter. Votes are summed in memory per (table, id) and written to DB in batches,
+so a popular story gets one UPDATE per flush instead of one per vote.
+
+Crash safety: every vote is appended to this worker's journal file before it is acknowledged.
+On flush the journal is renamed to a batch file, and the batch id is inserted into sf.vote_batches in the
+same transaction as the updates. Batch files left by a crash are applied on startup, at most once"""
+import os
+import asyncio
+from pathlib import Path
+from uuid import uuid4
+from loguru import logger
+from globals import get_conn
+from queries import fetch_one, execute, VOTES, ADD_VOTES, VOTE_BATCH_INSERT, VOTE_BATCHES_PURGE
+
+VOTE_FLUSH_INTERVAL = float(os.environ.get('VOTE_FLUSH_INTERVAL', '1'))  # seconds
+VOTE_FLUSH_SIZE = int(os.environ.get('VOTE_FLUSH_SIZE', '500'))  # flush earlier when this many rows wait
+VOTE_JOURNAL_DIR = Path(os.environ.get('VOTE_JOURNAL_DIR', 'vote_journal'))
+TABLES = ('stories', 'reviews')
+
+_pending: dict[tuple[str, int], int] = {}
+_unwritten: dict[str, dict[tuple[str, int], int]] = {}  # batch id -> votes taken for flush but not yet written
+_flush_needed = asyncio.Event()
+_lock = asyncio.Lock()
+_journal = None
+
+
+def _open_journal():
+    global _journal
+    VOTE_JOURNAL_DIR.mkdir(parents=True, exist_ok=True)
+    _journal = open(VOTE_JOURNAL_DIR / f'votes-{os.getpid()}.log', 'a')
+
+def _read_batch(file: Path) -> dict[tuple[str, int], int]:
+    deltas = {}
+    for line in file.read_text().splitlines():
+        try:
+            table, id, delta = line.split()
+        except ValueError:
+            continue  # line was cut by crash, this vote was never acknowledged
+        deltas[table, int(id)] = deltas.get((table, int(id)), 0) + int(delta)
+    return deltas
+
+def _pid_alive(pid):
+    if os.name == 'nt':
+        return True  # os.kill(pid, 0) would send Ctrl+C on Windows. Logs of dead workers wait for pid reuse
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+async def vote(table: str, id: int, delta: int) -> int | None:
+    """Count a vote. Returns the expected value after all pending votes are written, None if there is no such row"""
+    if table not in TABLES:
+        raise ValueError(f'Unknown table {table}')
+    async with get_conn() as conn:
+        row = await fetch_one(conn, VOTES[table], (id,))
+    if row is None:
+        return None
+    if _journal is None:
+        _open_journal()
+    _journal.write(f'{table} {id} {delta}\n')
+    _journal.flush()
+    key = table, id
+    _pending[key] = _pending.get(key, 0) + delta
+    if len(_pending) >= VOTE_FLUSH_SIZE:
+        _flush_needed.set()
+    return row[0] + _pending[key] + sum(deltas.get(key, 0) for deltas in _unwritten.values())
+
+
+async def _apply(batch_id: str, deltas: dict[tuple[str, int], int]):
+    """Write deltas in one transaction. Does nothing if batch with this id was already applied.
+    The rank trigger (migrations/002_story_rank.sql) keeps home feed order in sync"""
+    async with get_conn() as conn:
+        if not await execute(conn, VOTE_BATCH_INSERT, (batch_id,)):
+            return
+        for table in TABLES:
+            ids = [id for (t, id), delta in deltas.items() if t == table and delta]
+            if ids:
+                await execute(conn, ADD_VOTES[table], (ids, [deltas[table, id] for id in ids]))
+
+
+async def flush():
+    """Write all pending votes to DB. On failure votes stay in their batch and are retried by the next flush"""
+    global _pending
+    async with _lock:
+        if _pending:
+            batch_id = str(uuid4())
+            _journal.close()
+            os.replace(_journal.name, VOTE_JOURNAL_DIR / f'{batch_id}.batch')
+            _open_journal()
+            _unwritten[batch_id], _pending = _pending, {}
+        for batch_id, deltas in list(_unwritten.items()):
+            await _apply(batch_id, deltas)
+            del _unwritten[batch_id]
+            (VOTE_JOURNAL_DIR / f'{batch_id}.batch').unlink(missing_ok=True)
+
+
+async def recover():
+    """Apply batch files left by crashed workers. Call on startup.
+    Workers starting together recover the same files, and live workers remove their batches once written.
+    A file that disappears meanwhile was taken by another worker: the batch id makes applying it at most once"""
+    VOTE_JOURNAL_DIR.mkdir(parents=True, exist_ok=True)
+    for log in VOTE_JOURNAL_DIR.glob('votes-*.log'):
+        pid = int(log.stem.removeprefix('votes-'))
+        if pid == os.getpid() or not _pid_alive(pid):
+            try:
+                os.replace(log, VOTE_JOURNAL_DIR / f'{uuid4()}.batch')
+            except FileNotFoundError:
+                continue
+    for batch_file in VOTE_JOURNAL_DIR.glob('*.batch'):
+        try:
+            deltas = _read_batch(batch_file)
+        except FileNotFoundError:
+            continue
+        await _apply(batch_file.stem, deltas)
+        batch_file.unlink(missing_ok=True)
+        logger.info(f'Recovered votes from {batch_file.name}')
+    async with get_conn() as conn:
+        # A batch can only be replayed until its file is removed, so old ids are not needed
+        await execute(conn, VOTE_BATCHES_PURGE)
+
+
+async def flush_forever():
+    """Background task. Flushes every VOTE_FLUSH_INTERVAL seconds or when VOTE_FLUSH_SIZE rows are pending"""
+    while True:
+        try:
+            await asyncio.wait_for(_flush_needed.wait(), VOTE_FLUSH_INTERVAL)
+        except TimeoutError:
+            pass
+        _flush_needed.clear()
+        try:
+            await flush()
+        except Exception:
+            logger.exception('Failed to flush votes, they will be retried')